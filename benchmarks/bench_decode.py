@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""decode() throughput over streams from payload-heavy to dense small commands, in MB/s and commands/s.
+
+  python benchmarks/bench_decode.py
+  python benchmarks/bench_decode.py --repeat 9
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import vdptypes
+from bench_render_bytes import example_commands
+
+def uploads():
+  commands = []
+  for n in range(200):
+    commands += vdptypes.cmd_upload_blocks(bytes(16384), 100 + n)
+  return commands
+
+def draw_loop():
+  """bmp_select16 and bmp_draw alternating, so no two commands in a row are the same."""
+  commands = []
+  for n in range(20000):
+    commands.append({"command":"bmp_select16","n":100 + n % 8,"render":"bytes"})
+    commands.append({"command":"bmp_draw","x":n % 320,"y":n % 240,"render":"bytes"})
+  return commands
+
+def charbitmaps():
+  """One long run of the same fixed command, as when a font's characters are all mapped to bitmaps."""
+  return [{"command":"sys_charbitmap","char":n % 256,"bitmapid":500 + n % 256,"render":"bytes"} for n in range(40000)]
+
+def example_mix():
+  return example_commands() * 20
+
+STREAMS = (("uploads", uploads), ("example mix", example_mix), ("draw loop", draw_loop), ("charbitmaps", charbitmaps))
+
+def timed(data, repeat):
+  best = None
+  for r in range(repeat):
+    t0 = time.perf_counter()
+    count = len(vdptypes.decode(data))
+    elapsed = time.perf_counter() - t0
+    best = elapsed if best is None else min(best, elapsed)
+  return best, count
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--repeat", type=int, default=5)
+  args = parser.parse_args(argv)
+  print(f'{"stream":<12} {"bytes":>9} {"commands":>9} {"MB/s":>9} {"commands/s":>11}')
+  for name, make in STREAMS:
+    data = b"".join(bytes(n["bytes"]) for n in vdptypes.process(make()))
+    best, count = timed(data, args.repeat)
+    print(f'{name:<12} {len(data):9} {count:9} {len(data) / best / 1e6:9.2f} {count / best:11.0f}')
+
+if __name__=="__main__":
+  main()
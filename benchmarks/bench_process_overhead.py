@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+"""Per-call overhead of process() on small command lists.
+
+"before" rebuilds the full command table as a dict literal on every call, the way process() used to;
+"after" is process() with the module-level optable.
+
+  python benchmarks/bench_process_overhead.py
+"""
+
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import vdptypes
+
+def legacy_optable_builder():
+  """Compile a function that builds the optable dict literal from scratch, as process() did per call."""
+  source = "lambda: {" + ", ".join(f'"{k}":{k}' for k in vdptypes.optable) + "}"
+  return eval(source, vars(vdptypes))
+
+def main(number=20000):
+  build = legacy_optable_builder()
+  for count in (1, 4, 16):
+    commands = [{"command":"bmp_select16","n":100+n,"render":"bytes"} for n in range(count)]
+    def before():
+      build()
+      vdptypes.process(commands)
+    def after():
+      vdptypes.process(commands)
+    tb = min(timeit.repeat(before, number=number, repeat=5)) / number
+    ta = min(timeit.repeat(after, number=number, repeat=5)) / number
+    print(f'{count:3} commands: before {tb*1e6:8.2f} us/call  after {ta*1e6:8.2f} us/call  ({tb/ta:.1f}x)')
+
+if __name__=="__main__":
+  main()
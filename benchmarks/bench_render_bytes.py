@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""render_bytes over the example.py command mix: per-value to_bytes loop vs cached struct formats.
+
+  python benchmarks/bench_render_bytes.py
+"""
+
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import vdptypes
+
+def example_commands():
+  """A command mix modelled on the demos in example.py, without needing Pillow or sox_ng."""
+  commands = []
+  # demo3: audio setup
+  commands.append({"command":"mode_swap","render":"bytes"})
+  commands.append({"command":"aud_adsr","channel":1,"attack":1000,"decay":100,"sustain":64,"release":3000,"render":"bytes"})
+  commands.append({"command":"aud_freqenv_stepped","channel":1,"control":["repeats"],"steplength":100,"phases":[(100,2),(-100,3)],"render":"bytes"})
+  commands.append({"command":"aud_set_waveform","channel":1,"waveform":"triangle","render":"bytes"})
+  commands.append({"command":"aud_playnote","channel":1,"volume":127,"frequency":440,"duration":2000,"render":"bytes"})
+  commands.append({"command":"aud_set_duration","channel":1,"duration":3000,"render":"bytes"})
+  # demo2: sprite uploads, drawing and two tiled fonts
+  for n in range(4):
+    commands += vdptypes.cmd_upload_blocks(bytes(32*32), 100+n)
+    commands.append({"command":"bmp_select16","n":100+n,"render":"bytes"})
+    commands.append({"command":"bmp_makefrombuffer","w":32,"h":32,"format":"rgba2222","render":"bytes"})
+  for n in range(4):
+    commands.append({"command":"bmp_select16","n":100+n,"render":"bytes"})
+    commands.append({"command":"bmp_draw","x":32*n-16,"y":48,"render":"bytes"})
+  for fontbuffer, contextid in ((200, 10), (300, 20)):
+    commands.append({"command":"font_copysystem","bufferid":fontbuffer,"render":"bytes"})
+    commands.append({"command":"font_property","bufferid":fontbuffer,"field":"width","value":16,"render":"bytes"})
+    commands.append({"command":"font_property","bufferid":fontbuffer,"field":"height","value":16,"render":"bytes"})
+    commands.append({"command":"font_select","flags":[],"bufferid":fontbuffer,"render":"bytes"})
+    commands.append({"command":"ctx_select","contextid":contextid,"render":"bytes"})
+    for n in range(256):
+      commands.append({"command":"sys_charbitmap","char":n,"bitmapid":500+n,"render":"bytes"})
+    commands += vdptypes.cmd_hello_world("".join(chr(n) for n in range(32, 64)))
+  # demo_wavetable: scan table of buffer references
+  commands.append({"command":"buf_copyreference","targetbuffer":200,"sourcebuffer":[100+n//64 for n in range(384)],"render":"bytes"})
+  commands += vdptypes.cmd_testsample(1, 200, 128, 440)
+  return commands
+
+def encoded(commands):
+  """Run the encoders without rendering, so only render_bytes is timed."""
+  ans = []
+  for n in commands:
+    na = vdptypes.optable[n["command"]](dict(n))
+    ans.append(na)
+  return ans
+
+def timed(render, answers, repeat):
+  best = None
+  for r in range(repeat):
+    batch = [dict(na) for na in answers]
+    t0 = time.perf_counter()
+    for na in batch:
+      render(na)
+    elapsed = time.perf_counter() - t0
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+def loop_render(na):
+  na["bytes"] = vdptypes._render_bytes_loop(na)
+  return na
+
+def main(scale=50, repeat=5):
+  answers = encoded(example_commands()) * scale
+  before = timed(loop_render, answers, repeat)
+  after = timed(vdptypes.render_bytes, answers, repeat)
+  total = sum(len(loop_render(dict(na))["bytes"]) for na in answers)
+  print(f'{len(answers)} commands, {total} bytes')
+  print(f'per-value loop: {before*1e3:8.2f} ms  ({before/len(answers)*1e6:.2f} us/command)')
+  print(f'struct formats: {after*1e3:8.2f} ms  ({after/len(answers)*1e6:.2f} us/command)  {before/after:.1f}x')
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""Bytes on the wire for trimmed sprites: cmd_upload_preparedbitmaps (one upload per sprite) vs
+cmd_upload_spriteatlas (same-length bins split by buf_splitspread, the rest spread block by block by buf_spread).
+
+  python benchmarks/bench_spriteatlas_wire.py
+  python benchmarks/bench_spriteatlas_wire.py --frame 32 32
+
+The last row is a generated sheet of sprites of random sizes, so nearly every trimmed sprite has a length of its own.
+Needs Pillow.
+"""
+
+import argparse
+import random
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+import vdptypes
+
+EXAMPLE = ROOT / "example"
+
+def wire_bytes(commands):
+  return sum(len(n["bytes"]) for n in vdptypes.process(commands))
+
+def mixed_sheet(frame, count=256, seed=1):
+  """A sheet of count frames, each holding an opaque rectangle of random size, so trimming leaves mixed sizes."""
+  from PIL import Image
+  rng = random.Random(seed)
+  cols = 16
+  img = Image.new("RGBA", (frame[0] * cols, frame[1] * (count // cols)), (0,0,0,0))
+  for n in range(count):
+    w = rng.randint(1, frame[0])
+    h = rng.randint(1, frame[1])
+    x = (n % cols) * frame[0]
+    y = (n // cols) * frame[1]
+    img.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256), 255), (x, y, x + w, y + h))
+  return img
+
+def sheets(frame):
+  from PIL import Image
+  for path in sorted((EXAMPLE / "gfx" / "gfx").glob("*.png")) + [EXAMPLE / "smiley4.png", EXAMPLE / "tiles1.png"]:
+    yield path.name, Image.open(path)
+  yield "(mixed sizes)", mixed_sheet(frame)
+
+def measure(img, frame, iformat):
+  pbmps, errlog = vdptypes.PreparedBitmap.splitImage(img, iformat, 1000, frame=frame, mode="trim", dedupe=True)
+  bins, singles = vdptypes.atlas_bins(pbmps)
+  return {"count":len([n for n in pbmps if n.alias is None]),
+    "binned":sum(len(members) for blocksize, members in bins if blocksize is not None),
+    "mixed":sum(len(members) for blocksize, members in bins if blocksize is None),
+    "tiles":wire_bytes(vdptypes.cmd_upload_preparedbitmaps(pbmps)),
+    "atlas":wire_bytes(vdptypes.cmd_upload_spriteatlas(pbmps, 60000))}
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--frame", type=int, nargs=2, default=(16,16))
+  parser.add_argument("--format", default="RGBA2222")
+  args = parser.parse_args(argv)
+  frame = tuple(args.frame)
+  print(f'{"sheet":<16} {"sprites":>7} {"binned":>7} {"mixed":>7} {"per sprite":>10} {"atlas":>10} {"atlas saves":>11}')
+  totals = {"tiles":0, "atlas":0}
+  for name, img in sheets(frame):
+    n = measure(img, frame, args.format)
+    for k in totals:
+      totals[k] += n[k]
+    print(f'{name:<16} {n["count"]:7} {n["binned"]:7} {n["mixed"]:7} {n["tiles"]:10} {n["atlas"]:10} ' +
+      f'{1 - n["atlas"] / n["tiles"]:11.1%}')
+  print(f'{"total":<16} {"":7} {"":7} {"":7} {totals["tiles"]:10} {totals["atlas"]:10} ' +
+    f'{1 - totals["atlas"] / totals["tiles"]:11.1%}')
+
+if __name__=="__main__":
+  main()
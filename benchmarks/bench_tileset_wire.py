@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+"""Bytes on the wire for cmd_upload_font_tileset: tile by tile, tile by tile with dedupe, and the whole sheet
+sliced on the device (sheet_bufferid).
+
+  python benchmarks/bench_tileset_wire.py
+  python benchmarks/bench_tileset_wire.py --frame 16 16 --format RGBA8888
+
+Needs Pillow.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+import vdptypes
+
+EXAMPLE = ROOT / "example"
+
+def wire_bytes(commands):
+  return sum(len(n["bytes"]) for n in vdptypes.process(commands))
+
+def sheets():
+  return sorted((EXAMPLE / "gfx" / "gfx").glob("*.png")) + [EXAMPLE / "tiles1.png", EXAMPLE / "tiles3.png"]
+
+def measure(path, frame, iformat):
+  ans = {}
+  for name, options in (("tiles", {"dedupe":False}), ("dedupe", {"dedupe":True}), ("grid", {"dedupe":False, "sheet_bufferid":3000})):
+    result = vdptypes.cmd_upload_font_tileset(str(path), 500, 200, 10, frame, iformat, **options)
+    ans[name] = wire_bytes(result["commands"])
+    ans["count"] = len(result["pbmps"])
+  return ans
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--frame", type=int, nargs=2, default=(16,16))
+  parser.add_argument("--format", default="RGBA2222")
+  args = parser.parse_args(argv)
+  frame = tuple(args.frame)
+  print(f'{"sheet":<16} {"tiles":>6} {"per tile":>10} {"dedupe":>10} {"grid":>10} {"grid saves":>10}')
+  totals = {"tiles":0, "dedupe":0, "grid":0}
+  for path in sheets():
+    n = measure(path, frame, args.format)
+    for k in totals:
+      totals[k] += n[k]
+    print(f'{path.name:<16} {n["count"]:6} {n["tiles"]:10} {n["dedupe"]:10} {n["grid"]:10} ' +
+      f'{1 - n["grid"] / n["tiles"]:10.1%}')
+  print(f'{"total":<16} {"":6} {totals["tiles"]:10} {totals["dedupe"]:10} {totals["grid"]:10} ' +
+    f'{1 - totals["grid"] / totals["tiles"]:10.1%}')
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+"""Timing and memory suite for the encoders, image conversion and the buffer allocator.
+
+Each scenario is timed over several repeats (best and median are reported), then run once more under
+tracemalloc for its peak allocation. Results are printed as a table and can be written as JSON for
+comparison against an earlier run:
+
+  python benchmarks/run_suite.py --json results.json
+  python benchmarks/run_suite.py --compare results.json
+  python benchmarks/run_suite.py --only process_100k_mixed --repeat 3
+
+Scenarios that need Pillow are reported as skipped when it isn't installed.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+import vdptypes
+from bench_render_bytes import example_commands
+
+EXAMPLE = ROOT / "example"
+
+def _open_rgba(path):
+  from PIL import Image
+  img = Image.open(path)
+  img.load()
+  return img.convert("RGBA")
+
+def _copies(commands):
+  return [dict(n) if type(n) is dict else n for n in commands]
+
+def setup_process_100k_mixed():
+  mix = example_commands()
+  commands = (mix * (100000 // len(mix) + 1))[:100000]
+  return {"commands":commands, "items":len(commands)}
+
+def run_process_100k_mixed(state):
+  vdptypes.process(_copies(state["commands"]))
+
+def setup_buf_write_block_64k():
+  payload = bytes(n & 0xFF for n in range(65535))
+  commands = [{"command":"buf_write_block","bufferid":n,"buffer":payload,"render":"bytes"} for n in range(256)]
+  return {"commands":commands, "items":len(commands)}
+
+def run_buf_write_block_64k(state):
+  vdptypes.process(_copies(state["commands"]))
+
+def setup_buf_write_block_64k_list():
+  payload = [n & 0xFF for n in range(65535)]
+  commands = [{"command":"buf_write_block","bufferid":n,"buffer":payload,"render":"bytes"} for n in range(32)]
+  return {"commands":commands, "items":len(commands)}
+
+def setup_rgba2222_michi512():
+  img = _open_rgba(EXAMPLE / "michi512.png")
+  return {"img":img, "items":img.width * img.height}
+
+def run_rgba2222_michi512(state):
+  vdptypes.rgba8888_to_rgba2222(state["img"])
+
+def setup_splitimage_gfx():
+  sheets = [_open_rgba(n) for n in sorted((EXAMPLE / "gfx" / "gfx").glob("*.png"))]
+  return {"sheets":sheets, "items":sum((n.width // 16) * (n.height // 16) for n in sheets)}
+
+def run_splitimage_gfx(state):
+  for img in state["sheets"]:
+    vdptypes.PreparedBitmap.splitImage(img, "RGBA2222", 1000, frame=(16,16), mode="tile")
+
+def run_splitimage_gfx_trim(state):
+  for img in state["sheets"]:
+    vdptypes.PreparedBitmap.splitImage(img, "RGBA2222", 1000, frame=(16,16), mode="trim", origin=(8,8))
+
+def setup_allocator_search_10k():
+  alloc = vdptypes.VDPBufferAllocator()
+  alloc.define("assets", 1000, 10000)
+  for n in range(10000):
+    alloc.store("assets", f'asset{n}', n)
+  keys = [f'asset{(n * 7919) % 10000}' for n in range(1000)]
+  return {"alloc":alloc, "keys":keys, "items":len(keys)}
+
+def run_allocator_search_10k(state):
+  search = state["alloc"].search
+  for k in state["keys"]:
+    search(k)
+
+SCENARIOS = [
+  ("process_100k_mixed", "process() on 100k commands from the example.py mix", setup_process_100k_mixed,
+    run_process_100k_mixed, False),
+  ("buf_write_block_64k", "256 buf_write_block commands with 64 KB bytes payloads", setup_buf_write_block_64k,
+    run_buf_write_block_64k, False),
+  ("buf_write_block_64k_list", "32 buf_write_block commands with 64 KB list payloads", setup_buf_write_block_64k_list,
+    run_buf_write_block_64k, False),
+  ("rgba2222_michi512", "rgba8888_to_rgba2222 on michi512.png", setup_rgba2222_michi512,
+    run_rgba2222_michi512, True),
+  ("splitimage_gfx", "splitImage into 16x16 tiles on the example/gfx sheets", setup_splitimage_gfx,
+    run_splitimage_gfx, True),
+  ("splitimage_gfx_trim", "splitImage into alpha-trimmed 16x16 tiles on the example/gfx sheets", setup_splitimage_gfx,
+    run_splitimage_gfx_trim, True),
+  ("allocator_search_10k", "1000 VDPBufferAllocator.search calls over 10k stores", setup_allocator_search_10k,
+    run_allocator_search_10k, False),
+]
+
+def have_pillow():
+  try:
+    import PIL
+    return True
+  except ImportError:
+    return False
+
+def measure(setup, run, repeat):
+  times = []
+  for r in range(repeat):
+    state = setup()
+    t0 = time.perf_counter()
+    run(state)
+    times.append(time.perf_counter() - t0)
+  state = setup()
+  tracemalloc.start()
+  run(state)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  best = min(times)
+  return {"seconds_min":best, "seconds_median":statistics.median(times), "repeat":repeat,
+    "items":state["items"], "items_per_second":state["items"] / best if best > 0 else None, "peak_bytes":peak}
+
+def git_commit():
+  try:
+    out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+    return out.stdout.strip() or None
+  except OSError:
+    return None
+
+def run_suite(repeat=5, only=None):
+  pillow = have_pillow()
+  results = []
+  for name, desc, setup, run, needs_pillow in SCENARIOS:
+    if only and not name in only:
+      continue
+    entry = {"name":name, "description":desc}
+    if needs_pillow and not pillow:
+      entry["skipped"] = "Pillow not installed"
+    else:
+      entry.update(measure(setup, run, repeat))
+    results.append(entry)
+  return {"suite":"vdptypes", "version":vdptypes.__version__, "commit":git_commit(),
+    "python":platform.python_version(), "platform":platform.platform(),
+    "timestamp":time.strftime("%Y-%m-%dT%H:%M:%S%z"), "results":results}
+
+def format_table(report, baseline=None, threshold=0.10):
+  old = {}
+  if baseline is not None:
+    old = {n["name"]:n for n in baseline["results"] if "seconds_min" in n}
+  lines = [f'{"scenario":<26} {"best ms":>10} {"median ms":>10} {"items/s":>12} {"peak KB":>10}' +
+    ("  vs baseline" if baseline is not None else "")]
+  for n in report["results"]:
+    if "skipped" in n:
+      lines.append(f'{n["name"]:<26} skipped: {n["skipped"]}')
+      continue
+    line = (f'{n["name"]:<26} {n["seconds_min"]*1000:10.2f} {n["seconds_median"]*1000:10.2f} ' +
+      f'{n["items_per_second"] or 0:12.0f} {n["peak_bytes"]/1024:10.0f}')
+    if n["name"] in old:
+      ratio = n["seconds_min"] / old[n["name"]]["seconds_min"]
+      flag = "  REGRESSION" if ratio > 1 + threshold else ""
+      line += f'  {ratio:5.2f}x time{flag}'
+    lines.append(line)
+  return "\n".join(lines)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--only", nargs="*", help="scenario names to run")
+  parser.add_argument("--json", help="write results to this file")
+  parser.add_argument("--compare", help="earlier --json output to compare against")
+  parser.add_argument("--threshold", type=float, default=0.10, help="slowdown flagged as a regression (0.10 = 10%%)")
+  args = parser.parse_args(argv)
+  report = run_suite(args.repeat, args.only)
+  baseline = None
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+  print(format_table(report, baseline, args.threshold))
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(report, f, indent=1)
+  return report
+
+if __name__=="__main__":
+  main()
@@ -708,5 +708,33 @@ Then proceed towards audio.
 """
   print("OK")
 
+def build_demo1(path, sources):
+  from pathlib import Path
+  demo1(Path(sources[0]).parent, Path(path).parent)
+
+def build_demo2(path, sources):
+  from pathlib import Path
+  demo2(Path(sources[0]).parent, Path(path).parent)
+
+def build_demo3(path, sources):
+  from pathlib import Path
+  demo3(None, Path(path).parent)
+
+def build(inpath, outpath, force=False):
+  """Rebuild the demo outputs whose source images, or whose code, have changed since the last build.
+  Each demo writes its own michi.4th loader, so each gets its own directory under outpath."""
+  from pathlib import Path
+  init_path(outpath)
+  out1, out2, out3 = (outpath / Path(n) for n in ("demo1", "demo2", "demo3"))
+  graph = BuildGraph({
+    str(out1 / Path("michi.vdu")):{"sources":[str(inpath / Path("michi512.png"))], "generator":build_demo1,
+      "outputs":[str(out1 / Path("michi.4th"))]},
+    str(out2 / Path("demo2_3.vdu")):{"sources":[str(inpath / Path(n)) for n in ("smiley4.png", "tiles1.png", "tiles3.png")],
+      "generator":build_demo2, "outputs":[str(out2 / Path(n)) for n in ("demo2_1.vdu", "demo2_2.vdu", "michi.4th")]},
+    str(out3 / Path("demo3_1.vdu")):{"sources":[], "generator":build_demo3,
+      "outputs":[str(out3 / Path(n)) for n in ("demo3_2.vdu", "michi.4th")]},
+  }, statefile=str(outpath / Path("vdpbuild.json")))
+  return graph.build(force=force)
+
 if __name__=="__main__":
   demo0()
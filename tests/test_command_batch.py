@@ -0,0 +1,42 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import vdptypes
+
+np = pytest.importorskip("numpy")
+
+def one_by_one(command, columns, config=None):
+  configs = []
+  for idx in range(len(next(iter(columns.values())))):
+    n = dict(config or {})
+    n["command"] = command
+    n["render"] = "bytes"
+    for k in columns:
+      n[k] = columns[k][idx]
+    configs.append(n)
+  ans = vdptypes.process(configs)
+  log = [f'command {idx}: {msg}' for idx in range(len(ans)) for msg in ans[idx]["log"]]
+  return b"".join(bytes(n["bytes"]) for n in ans), log
+
+def test_float_column_matches_process():
+  xs = np.array([0.0, 1.5, -2.25, 300.0, 70000.5])
+  ys = np.array([1, -1, 2, -32768, 65535])
+  batch = vdptypes.CommandBatch("bmp_draw", {"x":xs, "y":ys}).render()
+  data, log = one_by_one("bmp_draw", {"x":xs.tolist(), "y":ys.tolist()})
+  assert batch["bytes"] == data
+  assert batch["log"] == log
+  assert len(batch["log"]) == 5
+
+def test_int_and_bool_columns_match_process():
+  xs = np.array([0, 1, -2, 300, 70000], dtype=np.int32)
+  ys = np.array([5, 6, 7, 8, 9], dtype=np.uint16)
+  batch = vdptypes.CommandBatch("bmp_draw", {"x":xs, "y":ys}).render()
+  data, log = one_by_one("bmp_draw", {"x":xs.tolist(), "y":ys.tolist()})
+  assert batch["bytes"] == data
+  assert batch["log"] == log
+  flags = vdptypes.CommandBatch("vdu_colour", {"colour":np.array([True, False, True])}).render()
+  assert flags["bytes"] == b"".join(bytes(n["bytes"]) for n in vdptypes.process(
+    [{"command":"vdu_colour","colour":c,"render":"bytes"} for c in (1, 0, 1)]))
@@ -0,0 +1,67 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import vdptypes
+
+def stream(commands):
+  return b"".join(bytes(n["bytes"]) for n in vdptypes.process(commands))
+
+def one_at_a_time(data):
+  """Decode without the run fast path: one trie walk per command."""
+  vdptypes.decode(b"")
+  view = memoryview(data)
+  ans = []
+  pos = 0
+  rawstart = None
+  while pos < len(data):
+    config, nxt, spec = vdptypes._decode_one(vdptypes._decode_trie, view, pos, len(data))
+    if config is None:
+      if rawstart is None:
+        rawstart = pos
+    else:
+      if rawstart is not None:
+        ans.append((rawstart, pos - rawstart, {"command":None, "raw":bytes(view[rawstart:pos])}))
+        rawstart = None
+      ans.append((pos, nxt - pos, config))
+    pos = nxt
+  if rawstart is not None:
+    ans.append((rawstart, pos - rawstart, {"command":None, "raw":bytes(view[rawstart:pos])}))
+  return ans
+
+def flat(entries):
+  ans = []
+  for n in entries:
+    config = dict(n["config"])
+    if "raw" in config:
+      config["raw"] = bytes(config["raw"])
+    ans.append((n["offset"], n["size"], config))
+  return ans
+
+def runs():
+  commands = []
+  for n in range(300):
+    commands.append({"command":"sys_charbitmap","char":n % 256,"bitmapid":500 + n,"render":"bytes"})
+  commands.append({"command":"bmp_select16","n":7,"render":"bytes"})
+  for n in range(70):
+    commands.append({"command":"bmp_draw","x":n - 35,"y":-n,"render":"bytes"})
+  commands.append({"command":"vdu_colour","colour":3,"render":"bytes"})
+  commands.append({"command":"vdu_colour","colour":4,"render":"bytes"})
+  return commands
+
+def test_runs_match_one_at_a_time():
+  data = stream(runs())
+  entries = vdptypes.decode(data)
+  assert flat(entries) == one_at_a_time(data)
+  configs = [dict(n["config"], render="bytes") for n in entries]
+  assert stream(configs) == data
+
+def test_broken_runs():
+  data = bytearray(stream(runs()))
+  data[6 * 40] = 0x55 # first byte of a sys_charbitmap in the middle of the run
+  data[6 * 100 + 2] = 0x01 # its selector
+  data += data[:3] # a command cut short by the end of the stream
+  data = bytes(data)
+  entries = vdptypes.decode(data)
+  assert flat(entries) == one_at_a_time(data)
+  assert entries[-1]["config"]["command"] is None
@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import vdptypes
+
+def upload_commands():
+  commands = []
+  for n in range(400):
+    commands += vdptypes.cmd_upload_blocks(bytearray(range(256)) * 3, 100 + n, blocksize=500)
+  commands.append({"command":"buf_write_block","bufferid":1,"buffer":memoryview(bytes(range(64))),"render":"bytes"})
+  return commands
+
+def expected(commands):
+  return [bytes(n["bytes"]) for n in vdptypes.process(vdptypes._copy_config(commands))]
+
+def test_uploads_through_pool():
+  commands = upload_commands()
+  ans = vdptypes.process_parallel(commands, workers=2, chunksize=256)
+  assert [n["bytes"] for n in ans] == expected(commands)
+  assert all(n["log"] == [] for n in ans)
+
+def test_inline_path_copies_configs():
+  config = {"command":"vdu_colour","render":"bytes"}
+  ans = vdptypes.process_parallel([config], workers=1)
+  assert config == {"command":"vdu_colour","render":"bytes"}
+  assert ans[0]["bytes"] == expected([config])[0]
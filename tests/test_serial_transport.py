@@ -0,0 +1,89 @@
+import os
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import vdptypes
+
+if os.name != "posix":
+  pytest.skip("needs a POSIX pty", allow_module_level=True)
+termios = pytest.importorskip("termios")
+
+class PtyReader(object):
+  """Drain the master side of a pty in a thread, so writes to the slave side never block."""
+  def __init__(self, master):
+    self.master = master
+    self.data = bytearray()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+  def run(self):
+    while True:
+      try:
+        block = os.read(self.master, 65536)
+      except OSError:
+        return
+      if not block:
+        return
+      self.data += block
+  def wait_for(self, count, timeout=5.0):
+    import time
+    deadline = time.monotonic() + timeout
+    while len(self.data) < count and time.monotonic() < deadline:
+      time.sleep(0.005)
+    return bytes(self.data)
+
+@pytest.fixture
+def pty_pair():
+  master, slave = os.openpty()
+  path = os.ttyname(slave)
+  reader = PtyReader(master)
+  yield path, reader
+  os.close(slave)
+  os.close(master)
+
+def transport(path, **options):
+  return vdptypes.SerialTransport(path, use_pyserial=False, **options)
+
+def test_write_chunks_and_paces(pty_pair):
+  path, reader = pty_pair
+  payload = bytes(n & 0xFF for n in range(1050))
+  with transport(path, chunksize=100, pace=0.01) as tx:
+    assert tx.fd is not None and tx.serial is None # raw termios backend
+    assert tx.write(payload) == len(payload)
+    stats = tx.stats()
+  assert reader.wait_for(len(payload)) == payload
+  assert stats["bytes"] == 1050
+  assert stats["chunks"] == 11
+  assert stats["seconds"] >= 11 * 0.01
+  assert stats["throughput"] == pytest.approx(stats["bytes"] / stats["seconds"])
+
+def test_send_packs_commands_into_chunks(pty_pair):
+  path, reader = pty_pair
+  commands = []
+  for n in range(40):
+    commands.append({"command":"vdu_colour","colour":n,"render":"bytes"})
+    commands += vdptypes.cmd_upload_blocks(bytes(range(50)), 100 + n)
+  expected = b"".join(bytes(n["bytes"]) for n in vdptypes.process(vdptypes._copy_config(commands)))
+  with transport(path, chunksize=256) as tx:
+    result = tx.send(commands)
+    stats = tx.stats()
+  assert result == {"log":[], "size":len(expected)}
+  assert reader.wait_for(len(expected)) == expected
+  assert stats["bytes"] == len(expected)
+  assert stats["chunks"] == -(-len(expected) // 256)
+
+def test_sendfile(pty_pair, tmp_path):
+  path, reader = pty_pair
+  vdufile = tmp_path / "test.vdu"
+  commands = vdptypes.cmd_upload_blocks(bytes(n & 0xFF for n in range(3000)), 7)
+  written = vdptypes.writevdu(str(vdufile), commands)
+  with transport(path, chunksize=512) as tx:
+    assert tx.sendfile(str(vdufile)) == written["size"]
+    stats = tx.stats()
+  assert reader.wait_for(written["size"]) == vdufile.read_bytes()
+  assert stats["bytes"] == written["size"]
+  assert stats["chunks"] == -(-written["size"] // 512)
+  assert stats["utilisation"] == pytest.approx(stats["throughput"] / (1152000 / 10))
@@ -0,0 +1,74 @@
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import vdptypes
+
+def run(commands):
+  """Replay the buffer and bitmap commands of an upload, returning the bitmaps made and the buffers left."""
+  data = b"".join(bytes(n["bytes"]) for n in vdptypes.process(commands))
+  buffers = {}
+  bitmaps = {}
+  selected = None
+  for entry in vdptypes.decode(data):
+    config = entry["config"]
+    command = config["command"]
+    if command == "buf_clear":
+      buffers.pop(config["bufferid"], None)
+    elif command == "buf_write_block":
+      buffers.setdefault(config["bufferid"], []).append(bytes(config["buffer"]))
+    elif command == "buf_consolidate":
+      buffers[config["bufferid"]] = [b"".join(buffers[config["bufferid"]])]
+    elif command == "buf_splitspread":
+      whole = b"".join(buffers[config["bufferid"]])
+      targets = config["targetbuffer"]
+      for n in targets:
+        buffers.pop(n, None)
+      blocks = [whole[n:n + config["blocksize"]] for n in range(0, len(whole), config["blocksize"])]
+      for n in range(len(blocks)):
+        buffers.setdefault(targets[n % len(targets)], []).append(blocks[n])
+    elif command == "buf_spread":
+      blocks = buffers[config["bufferid"]]
+      targets = config["targetbuffer"]
+      for n in targets:
+        buffers.pop(n, None)
+      for n in range(len(blocks)):
+        buffers.setdefault(targets[n % len(targets)], []).append(blocks[n])
+    elif command == "bmp_select16":
+      selected = config["n"]
+    elif command == "bmp_makefrombuffer":
+      assert len(buffers[selected]) == 1
+      bitmaps[selected] = (config["w"], config["h"], buffers[selected][0])
+    else:
+      raise AssertionError(command)
+  return bitmaps, buffers
+
+def sprites(count, seed=1):
+  rng = random.Random(seed)
+  ans = []
+  for n in range(count):
+    w = rng.choice((4, 8, 8, 8, rng.randint(1, 16)))
+    h = rng.choice((8, 8, rng.randint(1, 16)))
+    data = bytes(rng.randrange(256) for i in range(w * h))
+    ans.append(vdptypes.PreparedBitmap(None, "RGBA2222", 0, 0, 1000 + n, packed=(w, h, data)))
+  return ans
+
+def test_atlas_makes_the_same_bitmaps():
+  pbmps = sprites(200)
+  bins, singles = vdptypes.atlas_bins(pbmps)
+  assert any(blocksize is None for blocksize, members in bins)
+  assert any(blocksize is not None for blocksize, members in bins)
+  direct, left = run(vdptypes.cmd_upload_preparedbitmaps(pbmps))
+  atlas, left = run(vdptypes.cmd_upload_spriteatlas(pbmps, 60000))
+  assert atlas == direct
+  assert not 60000 in left
+
+def test_mixed_bin_needs_four():
+  pbmps = sprites(3, seed=2)
+  for n in range(3):
+    pbmps[n].data = bytes(n + 1)
+  assert vdptypes.atlas_bins(pbmps) == ([], pbmps)
+  pbmps += [vdptypes.PreparedBitmap(None, "RGBA2222", 0, 0, 2000, packed=(1, 9, bytes(9)))]
+  bins, singles = vdptypes.atlas_bins(pbmps)
+  assert bins == [(None, pbmps)] and singles == []
@@ -31,6 +31,10 @@ Add functions for asset conversion
 
 """
 
+import struct
+
+__version__ = "0.1.0"
+
 def _multiphase_array(config, level_duration, fieldname):
   """Convert list of tuples of (level, duration) to flat lists of bytecode data and size values."""
   count = len(level_duration)
@@ -41,7 +45,7 @@ def _multiphase_array(config, level_duration, fieldname):
     ans["field"] = []
     ans["data"].append(count)
     ans["size"].append(1)
-    ans["field"].append(fieldname + "Length")
+    ans["field"].append(fieldname + "Length" if _wants_fields(config) else None)
     for n in level_duration:
       ans["data"].append(n[0])
       ans["size"].append(1)
@@ -51,34 +55,52 @@ def _multiphase_array(config, level_duration, fieldname):
       ans["field"].append("duration")
   return ans
 
+def _bytepayload(ans, bytedata, fieldname):
+  """Convert a payload to a single bytes-like segment that render_bytes copies straight into the output.
+  bytes, bytearray and memoryview payloads are used as-is (without copying); sequences of ints are range-checked
+  with min()/max() and converted in one call, only falling back to a per-byte pass when something is out of range.
+  Negative values from -128 are stored as signed bytes."""
+  if isinstance(bytedata, (bytes, bytearray)):
+    return bytedata
+  if isinstance(bytedata, memoryview):
+    if bytedata.format != 'B' or bytedata.ndim != 1:
+      bytedata = bytedata.cast('B')
+    return bytedata
+  if len(bytedata) == 0:
+    return b''
+  lo = min(bytedata)
+  hi = max(bytedata)
+  if lo >= 0 and hi <= 255:
+    return bytes(bytedata)
+  ans["log"] += [f'bytearray {fieldname} has data that is out of range: byte {idx} is {n}. Zeroing.'
+    for idx, n in enumerate(bytedata) if (n < -128 or n > 255)]
+  return bytes([(n & 0xFF) if (-128 <= n <= 255) else 0 for n in bytedata])
+
 def _bytearray16(config, bytedata, fieldname):
-  """Convert sequence of bytes to flat lists of bytecode data and size values."""
-  count = len(bytedata)
+  """Convert sequence of bytes to a 16-bit length prefix followed by one payload segment."""
   ans = {}
   if "render" in config:
     ans["data"] = []
     ans["size"] = []
     ans["field"] = []
     ans["log"] = []
+    payload = _bytepayload(ans, bytedata, fieldname)
+    count = len(payload)
     if count > 65535:
       lstr = f'{fieldname} of size {count} bytes is too large for 16-bit bytearray. Truncating.'
       ans["log"].append(lstr)
-      bytedata = bytedata[:65535]
+      payload = memoryview(payload)[:65535]
       count = 65535
-    ans["data"].append(count)
-    ans["size"].append(2)
-    ans["field"].append(fieldname + "Length")
-    idx = 0
-    for n in bytedata:
-      if (n < -128 or n > 255):
-        ans["log"].append(f'bytearray {fieldname} has data that is out of range: byte {idx} is {n}. Zeroing.')
-        n = 0
-      ans["data"].append(n)
-      ans["size"].append(1)
-      ans["field"].append("v"+str(idx))
-      idx += 1
+    ans["data"] = [count, payload]
+    ans["size"] = [2, count]
+    ans["field"] = [fieldname + "Length" if _wants_fields(config) else None, fieldname]
   return ans
 
+def _wants_fields(config):
+  """Per-item field names (block0, adj3, bufferLength...) are only built for render:"offsets" or when the config
+  asks for them with "fields":True; otherwise those entries of ans["field"] are None."""
+  return config.get("render") == "offsets" or config.get("fields") is True
+
 def _merge_dsf(ans0, ans1):
   ans0["data"] = ans0["data"] + ans1["data"]
   ans0["size"] = ans0["size"] + ans1["size"]
@@ -104,7 +126,7 @@ def _bits_default(ans, config, fieldname, minbits=1, maxbits=8):
   elif not (type(config[fieldname]) is int):
     ans["log"].append(f'int type in bits {fieldname} missing, filling in with {minbits}.')
     config[fieldname] = minbits
-  elif (config[fieldname] < minbits or config[fieldname] > minbits):
+  elif (config[fieldname] < minbits or config[fieldname] > maxbits):
     ans["log"].append(f'bits {fieldname} out of range: {config[fieldname]}, filling in with {minbits}.')
     config[fieldname] = minbits
 
@@ -657,78 +679,82 @@ def vdu_graphicsviewport(config):
     ans["field"] = [None, "left", "bottom", "right", "top"]
   return ans
 
+_plot_styles = [
+  "solid_ab",
+  "solid_a",
+  "dotdash_ab_restart",
+  "dotdash_a_restart",
+  "solid_b",
+  "solid_",
+  "dotdash_b_continue",
+  "dotdash__continue",
+  "point",
+  "line_fill_non_bg",
+  "triangle_fill",
+  "line_fill_bg",
+  "rectangle_fill",
+  "line_fill_fg",
+  "parallelogram_fill",
+  "line_fill_non_fg",
+  "__flood_non_bg",
+  "__flood_fg",
+  "circle",
+  "circle_fill",
+  "circle_arc",
+  "circle_segment",
+  "circle_sector",
+  "rectangle_copy",
+  "__ellipse",
+  "__ellipse_fill",
+  "__208",
+  "fill_path",
+  "__224",
+  "bitmap",
+  "__240",
+  "__248"
+]
+_plot_style_codes = [
+  0,
+  8,
+  16,
+  24,
+  32,
+  40,
+  48,
+  56,
+  64,
+  72,
+  80,
+  88,
+  96,
+  104,
+  112,
+  120,
+  128,
+  136,
+  144,
+  152,
+  160,
+  168,
+  176,
+  184,
+  192,
+  200,
+  208,
+  216,
+  224,
+  232,
+  240,
+  248]
+_plot_actions = ["move_rel","plot_rel_fg","plot_rel_inv","plot_rel_bg", "move_abs", "plot_abs_fg","plot_abs_inv","plot_abs_bg"]
+
 def vdu_plot(config):
   ans = {"log":[],"doc":[]}
   if "doc" in config:
     ans["doc"].append("""PLOT commands""")
   if "render" in config:
-    style = _selectmap(ans,config,"style",[
-      "solid_ab",
-      "solid_a",
-      "dotdash_ab_restart",
-      "dotdash_a_restart",
-      "solid_b",
-      "solid_",
-      "dotdash_b_continue",
-      "dotdash__continue",
-      "point",
-      "line_fill_non_bg",
-      "triangle_fill",
-      "line_fill_bg",
-      "rectangle_fill",
-      "line_fill_fg",
-      "parallelogram_fill",
-      "line_fill_non_fg",
-      "__flood_non_bg",
-      "__flood_fg",
-      "circle",
-      "circle_fill",
-      "circle_arc",
-      "circle_segment",
-      "circle_sector",
-      "rectangle_copy",
-      "__ellipse",
-      "__ellipse_fill",
-      "__208",
-      "fill_path",
-      "__224",
-      "bitmap",
-      "__240",
-      "__248"],[
-      0,
-      8,
-      16,
-      24,
-      32,
-      40,
-      48,
-      56,
-      64,
-      72,
-      80,
-      88,
-      96,
-      104,
-      112,
-      120,
-      128,
-      136,
-      144,
-      152,
-      160,
-      168,
-      176,
-      184,
-      192,
-      200,
-      208,
-      216,
-      224,
-      232,
-      240,
-      248])
-    action = _selectmap(ans,config,"action",["move_rel","plot_rel_fg","plot_rel_inv","plot_rel_bg", "move_abs",
-      "plot_abs_fg","plot_abs_inv","plot_abs_bg"],[0,1,2,3,4,5,6,7])
+    style = _selectmap(ans,config,"style",_plot_styles,_plot_style_codes)
+    action = _selectmap(ans,config,"action",_plot_actions,[0,1,2,3,4,5,6,7])
     code = style + action
     _u16_default(ans, config, "x")
     _u16_default(ans, config, "y")
@@ -931,7 +957,7 @@ def sys_set_rtc(config):
     _u8_default(ans, config, "hour")
     _u8_default(ans, config, "min")
     _u8_default(ans, config, "sec")
-    ans["data"] = [23, 0, 0x87,  0, config["y"], config["m"],  config["d"], config["hour"], config["min"],  config["sec"]]
+    ans["data"] = [23, 0, 0x87,  1, config["y"], config["m"],  config["d"], config["hour"], config["min"],  config["sec"]]
     ans["size"] = [1, 1, 1,  1, 1, 1,  1, 1, 1,  1]
     ans["field"] = [None, None, None,  None, "y", "m",  "d", "hour", "min",  "sec"]
   return ans
@@ -1337,13 +1363,15 @@ def aud_set_frequency(config):
     ans["field"] = [None, None, None, "channel", None, "frequency"]
   return ans
 
+_waveforms = ["square","triangle","sawtooth","sine","noise","vicnoise",None, None, "sample"]
+
 def aud_set_waveform(config):
   ans = {"log":[],"doc":[]}
   if "doc" in config:
     ans["doc"].append("""Set waveform""")
   if "render" in config:
     _u8_default(ans, config, "channel")
-    waveform = _selectmap(ans, config, "waveform", ["square","triangle","sawtooth","sine","noise","vicnoise",None, None, "sample"])
+    waveform = _selectmap(ans, config, "waveform", _waveforms)
     ans["data"] = [23, 0, 0x85, config["channel"], 4, waveform]
     ans["size"] = [1, 1, 1, 1, 1, 1]
     ans["field"] = [None, None, None, "channel", None, "waveform"]
@@ -1361,15 +1389,10 @@ def aud_loadsample(config):
   if "render" in config:
     _u8_default(ans, config, "channel")
     _array_default(ans, config, "sample")
-    ans["data"] = [23, 0, 0x85, config["channel"], 5, 0, len(config["sample"])]
-    ans["size"] = [1, 1, 1, 1, 1, 1, 1, 3]
-    ans["field"] = [None, None, None, "channel", None, None, "length"]
-    count = 0
-    for n in config["sample"]:
-      ans["data"].append(n)
-      ans["size"].append(1)
-      ans["field"].append("s"+str(count))
-      count += 1
+    sample = _bytepayload(ans, config["sample"], "sample")
+    ans["data"] = [23, 0, 0x85, config["channel"], 5, 0, len(sample), sample]
+    ans["size"] = [1, 1, 1, 1, 1, 1, 3, len(sample)]
+    ans["field"] = [None, None, None, "channel", None, None, "length", "sample"]
   return ans
 
 def aud_clearsample(config):
@@ -1556,12 +1579,13 @@ def aud_freqenv_stepped(config):
     ans["data"] = [23, 0, 0x85, config["channel"], 7, 1, phasecount, controlbyte, config["steplength"]]
     ans["size"] = [1, 1, 1, 1, 1, 1, 1, 1, 2]
     ans["field"] = [None, None, None, "channel", None, None, "phasecount", "controlbyte", "steplength"]
+    fields = _wants_fields(config)
     count = 0
     for n in config["phases"]:
       ans["data"].append(n[0])
       ans["data"].append(n[1])
       ans["size"] += [2,2]
-      ans["field"] += ["adj"+str(count), "steps"+str(count)]
+      ans["field"] += ["adj"+str(count), "steps"+str(count)] if fields else [None, None]
       count += 1
   return ans
 
@@ -1670,6 +1694,7 @@ def buf_write_block(config):
     ans["field"] = [None, None, None, "bufferid", None]
     bufdata = _bytearray16(config, config["buffer"], "buffer")
     _merge_dsf(ans, bufdata)
+    ans["log"] += bufdata["log"]
   return ans
 
 def buf_call(config):
@@ -1750,9 +1775,10 @@ def buf_adjust_contents(config):
         ans["size"].append(2)
         ans["field"].append("count")
         # then iterate over the sequence:
+        fields = _wants_fields(config)
         for n in range(len(config["operand"])):
           _operand_default(ans, config["operand"], n, is_buffer_fetch, is_advanced_offset)
-          _merge_dsf(ans, _operand(config["operand"][n], f'operand{n}', is_buffer_fetch, is_advanced_offset))
+          _merge_dsf(ans, _operand(config["operand"][n], f'operand{n}' if fields else None, is_buffer_fetch, is_advanced_offset))
       else:
         # use the "count" parameter.
         _u16_default(ans, config, "count")
@@ -1920,11 +1946,12 @@ def buf_copyconcatblocks(config):
     ans["size"] = [1, 1, 1, 2, 1]
     ans["field"] = [None, None, None, "targetbuffer", None]
     _array_default(ans, config, "sourcebuffer")
+    fields = _wants_fields(config)
     for n in range(len(config["sourcebuffer"])):
       _u16_default(ans, config["sourcebuffer"], n)
       ans["data"].append(config["sourcebuffer"][n])
       ans["size"].append(2)
-      ans["field"].append(f'block{n}')
+      ans["field"].append(f'block{n}' if fields else None)
     ans["data"].append(65535)
     ans["size"].append(2)
     ans["field"].append(None)
@@ -1964,11 +1991,12 @@ def buf_splitspread(config):
     ans["size"] = [1, 1, 1, 2,1,2]
     ans["field"] = [None, None, None, "bufferid", None, "blocksize"]
     _array_default(ans, config, "targetbuffer")
+    fields = _wants_fields(config)
     for n in range(len(config["targetbuffer"])):
       _u16_default(ans, config["targetbuffer"], n)
       ans["data"].append(config["targetbuffer"][n])
       ans["size"].append(2)
-      ans["field"].append(f'block{n}')
+      ans["field"].append(f'block{n}' if fields else None)
     ans["data"].append(65535)
     ans["size"].append(2)
     ans["field"].append(None)
@@ -2012,11 +2040,12 @@ def buf_splitwidthspread(config):
     ans["size"] = [1, 1, 1, 2,1,2]
     ans["field"] = [None, None, None, "bufferid", None, "width"]
   _array_default(ans, config, "targetbuffer")
+  fields = _wants_fields(config)
   for n in range(len(config["targetbuffer"])):
     _u16_default(ans, config["targetbuffer"], n)
     ans["data"].append(config["targetbuffer"][n])
     ans["size"].append(2)
-    ans["field"].append(f'block{n}')
+    ans["field"].append(f'block{n}' if fields else None)
   ans["data"].append(65535)
   ans["size"].append(2)
   ans["field"].append(None)
@@ -2043,14 +2072,15 @@ def buf_spread(config):
   if "render" in config:
     _u16_default(ans, config, "bufferid")
     ans["data"] = [23, 0, 0xA0, config["bufferid"], 21]
-    ans["size"] = [1, 1, 1, 1,2,1]
+    ans["size"] = [1, 1, 1, 2,1]
     ans["field"] = [None, None, None, "bufferid", None]
   _array_default(ans, config, "targetbuffer")
+  fields = _wants_fields(config)
   for n in range(len(config["targetbuffer"])):
     _u16_default(ans, config["targetbuffer"], n)
     ans["data"].append(config["targetbuffer"][n])
     ans["size"].append(2)
-    ans["field"].append(f'block{n}')
+    ans["field"].append(f'block{n}' if fields else None)
   ans["data"].append(65535)
   ans["size"].append(2)
   ans["field"].append(None)
@@ -2126,11 +2156,12 @@ def buf_copyreference(config):
     ans["size"] = [1, 1, 1, 2, 1]
     ans["field"] = [None, None, None, "targetbuffer", None]
     _array_default(ans, config, "sourcebuffer")
+    fields = _wants_fields(config)
     for n in range(len(config["sourcebuffer"])):
       _u16_default(ans, config["sourcebuffer"], n)
       ans["data"].append(config["sourcebuffer"][n])
       ans["size"].append(2)
-      ans["field"].append(f'block{n}')
+      ans["field"].append(f'block{n}' if fields else None)
     ans["data"].append(65535)
     ans["size"].append(2)
     ans["field"].append(None)
@@ -2146,11 +2177,12 @@ def buf_copyconsolidate(config):
     ans["size"] = [1, 1, 1, 2, 1]
     ans["field"] = [None, None, None, "targetbuffer", None]
     _array_default(ans, config, "sourcebuffer")
+    fields = _wants_fields(config)
     for n in range(len(config["sourcebuffer"])):
       _u16_default(ans, config["sourcebuffer"], n)
       ans["data"].append(config["sourcebuffer"][n])
       ans["size"].append(2)
-      ans["field"].append(f'block{n}')
+      ans["field"].append(f'block{n}' if fields else None)
     ans["data"].append(65535)
     ans["size"].append(2)
     ans["field"].append(None)
@@ -2191,38 +2223,39 @@ def buf_expandbitmap(config):
     bitlut = (None,1,2,3,4,5,6,7,0) # this call defines the bit pattern so that no bits set = 8 bits
     maplen = (None,2,4,8,16,32,64,128,256) # this is how many values are needed in the map for that bit width
     opt = bitlut[config["bits"]]
-    if "width" in config:
-      opt = opt | 0x03
-    if "buffermap" in config:
-      opt = opt | 0x04
+    if "width" in config: # each row of the source starts on a byte boundary
+      opt = opt | 0x08
+    if "buffermap" in config: # the map is read from a buffer instead of following the command
+      opt = opt | 0x10
 
     _u16_default(ans, config, "sourceid")
 
     ans["data"] = [23, 0, 0xA0, config["targetid"], 72, opt, config["sourceid"]]
-    ans["size"] = [1, 1, 1, 2,1,2]
-    ans["field"] = [None, None, None, "targetid", None, "sourceid"]
+    ans["size"] = [1, 1, 1, 2, 1, 1, 2]
+    ans["field"] = [None, None, None, "targetid", None, None, "sourceid"]
 
-    if "width" in config["options"]:
+    if "width" in config:
       _u16_default(ans, config, "width")
       ans["data"].append(config["width"])
       ans["size"].append(2)
       ans["field"].append("width")
-    if "buffermap" in config["options"]:
+    if "buffermap" in config:
       _u16_default(ans, config, "buffermap")
       ans["data"].append(config["buffermap"])
       ans["size"].append(2)
       ans["field"].append("buffermap")
-    elif len(config["map"]) == maplen[config["bits"]]:
+    elif "map" in config and len(config["map"]) == maplen[config["bits"]]:
       for n in range(maplen[config["bits"]]):
-        ans["data"].append(config["bits"][n])
+        _u8_default(ans, config["map"], n)
+        ans["data"].append(config["map"][n])
         ans["size"].append(1)
-        ans["field"].append("map"+str(n))
+        ans["field"].append("map"+str(n) if _wants_fields(config) else None)
     else:
       ans["log"].append(f'couldn\'t find a map or buffermap, filling in the map with an ascending sequence.')
       for n in range(maplen[config["bits"]]):
         ans["data"].append(n % 256)
         ans["size"].append(1)
-        ans["field"].append("map"+str(n))
+        ans["field"].append("map"+str(n) if _wants_fields(config) else None)
 
   return ans
 
@@ -2264,12 +2297,10 @@ def bmp_load8(config):
     if "data" in config:
       xlength = config["w"] * config["h"]
       if len(config["data"]) == xlength:
-        count = 0
-        for n in config["data"]:
-          ans["data"].append(n)
-          ans["size"].append(1)
-          ans["field"].append("n"+str(count))
-          count += 1
+        bitmap = _bytepayload(ans, config["data"], "data")
+        ans["data"].append(bitmap)
+        ans["size"].append(len(bitmap))
+        ans["field"].append("data")
       else:
         ans["log"].append(f'length of bitmap data{len(config["data"])} is a mismatch for given size {config["w"]} x {config["h"]} = {xlength}. Appending ascending values instead.')
     else:
@@ -2324,6 +2355,8 @@ def bmp_select16(config):
     ans["field"] = [None, None, None, "n"]
   return ans
 
+_bitmap_formats = ["rgba8888", "rgba2222", "monomask", "_reserved"]
+
 def bmp_makefrombuffer(config):
   ans = {"log":[],"doc":[]}
   if "doc" in config:
@@ -2331,7 +2364,7 @@ def bmp_makefrombuffer(config):
   if "render" in config:
     _u16_default(ans, config, "w")
     _u16_default(ans, config, "h")
-    bformat = _selectmap(ans, config, "format", ["rgba8888", "rgba2222", "monomask", "_reserved"])
+    bformat = _selectmap(ans, config, "format", _bitmap_formats)
     ans["data"] = [23, 27, 0x21, config["w"], config["h"], bformat]
     ans["size"] = [1, 1, 1, 2, 2, 1]
     ans["field"] = [None, None, None, "w", "h", "format"]
@@ -2613,15 +2646,15 @@ def ctx_clear(config):
     ans["field"] = [None, None, None, None]
   return ans
 
+_font_flags = ["align_baseline","_reserved1","_reserved2","_reserved3","_reserved4","_reserved5","_reserved6","_reserved7"]
+
 def font_select(config):
   ans = {"log":[],"doc":[]}
   if "doc" in config:
     ans["doc"].append("Select font")
   if "render" in config:
     _u16_default(ans, config, "bufferid")
-    flags = _flagmap(ans, config, "flags", 
-      ["align_baseline","_reserved1","_reserved2","_reserved3","_reserved4","_reserved5","_reserved6","_reserved7"],
-      [1,2,4,8,16,32,64,128])
+    flags = _flagmap(ans, config, "flags", _font_flags, [1,2,4,8,16,32,64,128])
     ans["data"] = [23, 0, 0x95, 0, config["bufferid"], flags]
     ans["size"] = [1, 1, 1, 1, 2, 1]
     ans["field"] = [None, None, None, None, "bufferid", "flags"]
@@ -2642,13 +2675,15 @@ def font_create(config):
     ans["field"] = [None, None, None, None, "bufferid", "width", "height", "ascent", "flags"]
   return ans
 
+_font_fields = ["width", "height", "ascent", "flags", "_bufferchar", "_pointsize", "_inleading", "_exleading", "_weight", "_charset", "_codepage"]
+
 def font_property(config):
   ans = {"log":[],"doc":[]}
   if "doc" in config:
     ans["doc"].append("Set or adjust font property")
   if "render" in config:
     _u16_default(ans, config, "bufferid")
-    field = _selectmap(ans, config, "field", ["width", "height", "ascent", "flags", "_bufferchar", "_pointsize", "_inleading", "_exleading", "_weight", "_charset", "_codepage"])
+    field = _selectmap(ans, config, "field", _font_fields)
     _u16_default(ans, config, "value")
     ans["data"] = [23, 0, 0x95, 2, config["bufferid"], field, config["value"]]
     ans["size"] = [1, 1, 1, 1, 2, 1, 2]
@@ -2677,6 +2712,211 @@ def font_copysystem(config):
     ans["field"] = [None, None, None, None, "bufferid"]
   return ans
 
+"""Fixed layouts for commands whose bytes are a constant header plus integer fields taken directly from the
+config. Each entry mirrors the encoder's own data and size lists, with field names in place of config values.
+render:"fast" compiles these into struct formats and packs the whole command in one call; commands that
+are not listed here, or configs that need a default filled in, go through the regular encoder instead."""
+
+_fast_layouts = {
+  "vdu_null": ([0], [1]),
+  "vdu_printernext": ([1], [1]),
+  "vdu_printerenable": ([2], [1]),
+  "vdu_printerdisable": ([3], [1]),
+  "vdu_writetext": ([4], [1]),
+  "vdu_writegraphics": ([5], [1]),
+  "vdu_enablescreen": ([6], [1]),
+  "vdu_beep": ([7], [1]),
+  "vdu_back": ([8], [1]),
+  "vdu_forward": ([9], [1]),
+  "vdu_down": ([10], [1]),
+  "vdu_up": ([11], [1]),
+  "vdu_cls": ([12], [1]),
+  "vdu_cr": ([13], [1]),
+  "vdu_pageon": ([14], [1]),
+  "vdu_pageoff": ([15], [1]),
+  "vdu_clg": ([16], [1]),
+  "vdu_colour": ([17, 'colour'], [1, 1]),
+  "vdu_colourmode": ([18, 'mode', 'colour'], [1, 1, 1]),
+  "vdu_colourlogical": ([19, 'l', 'p', 'r', 'g', 'b'], [1, 1, 1, 1, 1, 1]),
+  "vdu_colourreset": ([20], [1]),
+  "vdu_screendisable": ([21], [1]),
+  "vdu_screenmode": ([22, 'mode'], [1, 1]),
+  "vdu_linethickness": ([23, 23, 'thickness'], [1, 1, 1]),
+  "vdu_hexload": ([23, 28], [1, 1]),
+  "vdu_graphicsviewport": ([24, 'left', 'bottom', 'right', 'top'], [1, 2, 2, 2, 2]),
+  "vdu_resetviewports": ([26], [1]),
+  "vdu_charoutput": ([27, 'char'], [1, 1]),
+  "vdu_textviewport": ([28, 'left', 'bottom', 'right', 'top'], [1, 1, 1, 1, 1]),
+  "vdu_graphicsorigin": ([29, 'x', 'y'], [1, 2, 2]),
+  "vdu_home": ([30], [1]),
+  "vdu_cursormove": ([31, 'x', 'y'], [1, 1, 1]),
+  "vdu_backspace": ([127], [1]),
+  "aud_playnote": ([23, 0, 0x85, 'channel', 0, 'volume', 'frequency', 'duration'], [1, 1, 1, 1, 1, 1, 2, 2]),
+  "aud_set_volume": ([23, 0, 0x85, 'channel', 2, 'volume'], [1, 1, 1, 1, 1, 1]),
+  "aud_set_frequency": ([23, 0, 0x85, 'channel', 3, 'frequency'], [1, 1, 1, 1, 1, 2]),
+  "aud_set_samplebufferbasefrequency": ([23, 0, 0x85, 'channel', 5, 4, 'bufferid', 'frequency'], [1, 1, 1, 1, 1, 1, 2, 2]),
+  "aud_disable_envelope": ([23, 0, 0x85, 'channel', 6, 0], [1, 1, 1, 1, 1, 1]),
+  "aud_adsr": ([23, 0, 0x85, 'channel', 6, 1, 'attack', 'decay', 'sustain', 'release'], [1, 1, 1, 1, 1, 1, 2, 2, 1, 2]),
+  "aud_freqenv_off": ([23, 0, 0x85, 'channel', 7, 0], [1, 1, 1, 1, 1, 1]),
+  "aud_enable_channel": ([23, 0, 0x85, 'channel', 8], [1, 1, 1, 1, 1]),
+  "aud_disable_channel": ([23, 0, 0x85, 'channel', 9], [1, 1, 1, 1, 1]),
+  "aud_reset_channel": ([23, 0, 0x85, 'channel', 10], [1, 1, 1, 1, 1]),
+  "aud_seek": ([23, 0, 0x85, 'channel', 11, 'position'], [1, 1, 1, 1, 1, 3]),
+  "aud_set_duration": ([23, 0, 0x85, 'channel', 12, 'duration'], [1, 1, 1, 1, 1, 3]),
+  "aud_set_samplerate": ([23, 0, 0x85, 'channel', 13, 'samplerate'], [1, 1, 1, 1, 1, 2]),
+  "buf_call": ([23, 0, 0xA0, 'bufferid', 1], [1, 1, 1, 2, 1]),
+  "buf_clear": ([23, 0, 0xA0, 'bufferid', 2], [1, 1, 1, 2, 1]),
+  "buf_create_writeable": ([23, 0, 0xA0, 'bufferid', 3, 'length'], [1, 1, 1, 2, 1, 2]),
+  "buf_set_output_stream": ([23, 0, 0xA0, 'bufferid', 4], [1, 1, 1, 2, 1]),
+  "buf_jump": ([23, 0, 0xA0, 'bufferid', 7], [1, 1, 1, 2, 1]),
+  "buf_consolidate": ([23, 0, 0xA0, 'bufferid', 14], [1, 1, 1, 2, 1]),
+  "buf_split": ([23, 0, 0xA0, 'bufferid', 15, 'blocksize'], [1, 1, 1, 2, 1, 2]),
+  "buf_splitspreadid": ([23, 0, 0xA0, 'bufferid', 17, 'blocksize', 'targetid'], [1, 1, 1, 2, 1, 2, 2]),
+  "buf_splitwidth": ([23, 0, 0xA0, 'bufferid', 18, 'width', 'blockcount'], [1, 1, 1, 2, 1, 2, 2]),
+  "buf_splitspreadwidthid": ([23, 0, 0xA0, 'bufferid', 20, 'width', 'blockcount', 'targetid'], [1, 1, 1, 2, 1, 2, 2, 2]),
+  "buf_spreadid": ([23, 0, 0xA0, 'bufferid', 22, 'targetid'], [1, 1, 1, 2, 1, 2]),
+  "buf_reverseblocks": ([23, 0, 0xA0, 'bufferid', 23], [1, 1, 1, 2, 1]),
+  "buf_compress": ([23, 0, 0xA0, 'targetid', 64, 'sourceid'], [1, 1, 1, 2, 1, 2]),
+  "buf_decompress": ([23, 0, 0xA0, 'targetid', 65, 'sourceid'], [1, 1, 1, 2, 1, 2]),
+  "buf_debug": ([23, 0, 0xA0, 'bufferid', 128], [1, 1, 1, 2, 1]),
+  "sys_terminal": ([23, 0, 0xFF], [1, 1, 1]),
+  "sys_consolemode": ([23, 0, 0xFE, 'n'], [1, 1, 1, 1]),
+  "sys_testflagclear": ([23, 0, 0xF9, 'flagid'], [1, 1, 1, 2]),
+  "sys_testflag": ([23, 0, 0xF8, 'flagid', 'value'], [1, 1, 1, 2, 2]),
+  "sys_dotdashlength": ([23, 0, 0xF2, 'n'], [1, 1, 1, 1]),
+  "sys_logicalscaling": ([23, 0, 0xC0, 'n'], [1, 1, 1, 1]),
+  "sys_updatevdp": ([23, 0, 0xA1], [1, 1, 1]),
+  "sys_graphicsoriginviewfromcursor": ([23, 0, 0x9F], [1, 1, 1]),
+  "sys_graphicsoriginfromplot": ([23, 0, 0x9E], [1, 1, 1]),
+  "sys_graphicsviewportfromplot": ([23, 0, 0x9D], [1, 1, 1]),
+  "sys_textviewportfromplot": ([23, 0, 0x9C], [1, 1, 1]),
+  "sys_printbuffer": ([23, 0, 0x9B, 'bufferid'], [1, 1, 1, 2]),
+  "sys_get_palettecolour": ([23, 0, 0x94, 'n'], [1, 1, 1, 2]),
+  "sys_get_graphicscode": ([23, 0, 0x93, 'x', 'y'], [1, 1, 1, 2, 2]),
+  "sys_cursorrelmove": ([23, 0, 0x8C, 'x', 'y'], [1, 1, 1, 2, 2]),
+  "sys_resetsysfont": ([23, 0, 0x91], [1, 1, 1]),
+  "sys_charbitmap": ([23, 0, 0x92, 'char', 'bitmapid'], [1, 1, 1, 1, 2]),
+  "sys_cursorendcol": ([23, 0, 0x8B, 'end'], [1, 1, 1, 1]),
+  "sys_cursorstartcol": ([23, 0, 0x8A, 'start'], [1, 1, 1, 1]),
+  "sys_mousewheelacceleration": ([23, 0, 0x89, 10, 'acceleration'], [1, 1, 1, 1, 3]),
+  "sys_mouseacceleration": ([23, 0, 0x89, 9, 'acceleration'], [1, 1, 1, 1, 2]),
+  "sys_mousescaling": ([23, 0, 0x89, 8, 'scaling'], [1, 1, 1, 1, 1]),
+  "sys_mouseresolution": ([23, 0, 0x89, 7, 'resolution'], [1, 1, 1, 1, 1]),
+  "sys_mousesamplerate": ([23, 0, 0x89, 6, 'rate'], [1, 1, 1, 1, 1]),
+  "sys_mouseposition": ([23, 0, 0x89, 4, 'x', 'y'], [1, 1, 1, 1, 2, 2]),
+  "sys_mousecursor": ([23, 0, 0x89, 3, 'cursor'], [1, 1, 1, 1, 2]),
+  "sys_mousereset": ([23, 0, 0x89, 2], [1, 1, 1, 1]),
+  "sys_mousedisable": ([23, 0, 0x89, 1], [1, 1, 1, 1]),
+  "sys_mouseenable": ([23, 0, 0x89, 0], [1, 1, 1, 1]),
+  "sys_set_rtc": ([23, 0, 0x87, 1, 'y', 'm', 'd', 'hour', 'min', 'sec'], [1, 1, 1, 1, 1, 1, 1, 1, 1, 1]),
+  "sys_get_rtc": ([23, 0, 0x87, 0], [1, 1, 1, 1]),
+  "sys_get_screendimensions": ([23, 0, 0x86], [1, 1, 1]),
+  "sys_get_pixelcolour": ([23, 0, 0x84, 'x', 'y'], [1, 1, 1, 2, 2]),
+  "sys_get_textcode": ([23, 0, 0x83, 'x', 'y'], [1, 1, 1, 2, 2]),
+  "sys_keyboardlocale": ([23, 0, 0x81, 'n'], [1, 1, 1, 1]),
+  "sys_poll": ([23, 0, 0x80, 'n'], [1, 1, 1, 1]),
+  "sys_cursorend": ([23, 0, 0x0B, 'end'], [1, 1, 1, 1]),
+  "mode_logicalscale": ([23, 0, 0xC0, 'setting'], [1, 1, 1, 1]),
+  "mode_legacy": ([23, 0, 0xC1, 'setting'], [1, 1, 1, 1]),
+  "mode_swap": ([23, 0, 0xC3], [1, 1, 1]),
+  "mode_flush": ([23, 0, 0xCA], [1, 1, 1]),
+  "bmp_select8": ([23, 27, 0, 'n'], [1, 1, 1, 1]),
+  "bmp_capture8": ([23, 27, 1, 'n', 0, 0], [1, 1, 1, 1, 1, 1]),
+  "bmp_makerect": ([23, 27, 2, 'w', 'h', 'col'], [1, 1, 1, 2, 2, 4]),
+  "bmp_draw": ([23, 27, 3, 'x', 'y'], [1, 1, 1, 2, 2]),
+  "bmp_select16": ([23, 27, 0x20, 'n'], [1, 1, 1, 2]),
+  "spr_select": ([23, 27, 4, 'n'], [1, 1, 1, 1]),
+  "spr_clear": ([23, 27, 5], [1, 1, 1]),
+  "spr_append8": ([23, 27, 6, 'n'], [1, 1, 1, 1]),
+  "spr_activate": ([23, 27, 7, 'n'], [1, 1, 1, 1]),
+  "spr_next": ([23, 27, 8], [1, 1, 1]),
+  "spr_prev": ([23, 27, 9], [1, 1, 1]),
+  "spr_frame": ([23, 27, 10, 'n'], [1, 1, 1, 1]),
+  "spr_show": ([23, 27, 11], [1, 1, 1]),
+  "spr_hide": ([23, 27, 12], [1, 1, 1]),
+  "spr_absmove": ([23, 27, 13, 'x', 'y'], [1, 1, 1, 2, 2]),
+  "spr_relmove": ([23, 27, 14, 'x', 'y'], [1, 1, 1, 2, 2]),
+  "spr_update": ([23, 27, 15], [1, 1, 1]),
+  "spr_resetall": ([23, 27, 16], [1, 1, 1]),
+  "spr_resetspr": ([23, 27, 17], [1, 1, 1]),
+  "spr_gcol": ([23, 27, 18, 'n'], [1, 1, 1, 1]),
+  "spr_append16": ([23, 27, 0x26, 'n'], [1, 1, 1, 2]),
+  "spr_cursor": ([23, 27, 0x40, 'hotx', 'hoty'], [1, 1, 1, 1, 1]),
+  "ctx_select": ([23, 0, 0xC8, 0, 'contextid'], [1, 1, 1, 1, 1]),
+  "ctx_delete": ([23, 0, 0xC8, 1, 'contextid'], [1, 1, 1, 1, 1]),
+  "ctx_reset": ([23, 0, 0xC8, 2], [1, 1, 1, 1]),
+  "ctx_save": ([23, 0, 0xC8, 3], [1, 1, 1, 1]),
+  "ctx_restore": ([23, 0, 0xC8, 4], [1, 1, 1, 1]),
+  "ctx_saveselect": ([23, 0, 0xC8, 5, 'contextid'], [1, 1, 1, 1, 1]),
+  "ctx_restoreall": ([23, 0, 0xC8, 6], [1, 1, 1, 1]),
+  "ctx_clear": ([23, 0, 0xC8, 7], [1, 1, 1, 1]),
+  "font_create": ([23, 0, 0x95, 1, 'bufferid', 'width', 'height', 'ascent', 'flags'], [1, 1, 1, 1, 2, 1, 1, 1, 1]),
+  "font_clear": ([23, 0, 0x95, 4, 'bufferid'], [1, 1, 1, 1, 2]),
+  "font_copysystem": ([23, 0, 0x95, 5, 'bufferid'], [1, 1, 1, 1, 2]),
+}
+
+_fast_compiled = {}
+
+_fast_ranges = {1:(-128, 255), 2:(-32768, 65535), 3:(-8388608, 16777215), 4:(-2147483648, 4294967295)}
+_fast_codes = {1:"B", 2:"H", 3:"HB", 4:"I"}
+
+def _compile_layout(data, size):
+  """Compile a fixed layout into (struct, argument template, field slots).
+  24-bit fields are packed as a 16-bit low word followed by the high byte."""
+  fmt = "<"
+  template = []
+  slots = []
+  for n in range(len(data)):
+    fmt += _fast_codes[size[n]]
+    lo, hi = _fast_ranges[size[n]]
+    if type(data[n]) is str:
+      slots.append((data[n], len(template), size[n], lo, hi, 1 << (8 * size[n])))
+      template.append(0)
+    else:
+      template.append(data[n])
+    if size[n] == 3:
+      template.append(0)
+  return (struct.Struct(fmt), template, slots)
+
+def _fast_layout(command):
+  layout = _fast_compiled.get(command)
+  if layout is None:
+    if not command in _fast_layouts:
+      return None
+    layout = _compile_layout(*_fast_layouts[command])
+    _fast_compiled[command] = layout
+  return layout
+
+def render_fast(config):
+  """Pack a config with a compiled fixed layout, returning the bytes or None if the command has to go through
+  its regular encoder (no layout, doc requested, or a field that is missing or needs a default filled in)."""
+  layout = _fast_layout(config["command"])
+  if layout is None or "doc" in config:
+    return None
+  args = _fast_args(layout, config)
+  if args is None:
+    return None
+  return layout[0].pack(*args)
+
+def _fast_args(layout, config):
+  """Fill a compiled layout's argument template from config, or return None if a field is missing or out of range."""
+  st, template, slots = layout
+  args = template.copy()
+  for name, pos, size, lo, hi, mod in slots:
+    if not name in config:
+      return None
+    val = config[name]
+    if not (type(val) is int) or val < lo or val > hi:
+      return None
+    if val < 0:
+      val += mod
+    if size == 3:
+      args[pos] = val & 0xFFFF
+      args[pos+1] = val >> 16
+    else:
+      args[pos] = val
+  return args
+
 def render_offsets(ans):
   offset = 0
   ans["offset"] = []
@@ -2685,225 +2925,1315 @@ def render_offsets(ans):
     offset += n
   return ans
 
+def describe_fields(config):
+  """Compute the field metadata of one config on demand, as a list of (field, offset, size) tuples.
+  Works on a copy of the config, so defaults aren't filled in on the original."""
+  probe = _copy_config(config)
+  probe["render"] = "offsets"
+  probe["fields"] = True
+  na = optable[config["command"]](probe)
+  render_offsets(na)
+  return list(zip(na["field"], na["offset"], na["size"]))
+
+def _render_bytes_loop(ans):
+  """Reference renderer: converts one value at a time. Used when a command carries payload segments or values
+  that don't fit their size, so that errors surface exactly as before."""
+  out = []
+  for n in range(len(ans["data"])):
+    size = ans["size"][n]
+    rawd = ans["data"][n]
+    if not (type(rawd) is int): # payload segment, already bytes
+      out.append(rawd)
+      continue
+    if (rawd < 0): # negative values are written as two's complement
+      if size>=1 and size<=4:
+        rawd += 1 << (8 * size)
+      else:
+        print(ans["data"])
+        raise Exception("I don't know how to deal with a negative value ("+str(rawd)+") of size "+str(size))
+    out.append(rawd.to_bytes(size, byteorder='little'))
+  return b''.join(out)
+
+_size_structs = {}
+_size_codes = {1:"B", 2:"H", 4:"I"}
+
+def _size_struct(sizes):
+  """Build (struct, split24, mods) for a tuple of sizes: struct packs the whole command in one call; split24 lists
+  the positions of 24-bit values, which are packed as a 16-bit low word plus the high byte; mods holds the modulus
+  added to negative values of each size. Returns None for sizes struct can't express."""
+  fmt = "<"
+  split24 = []
+  for n in range(len(sizes)):
+    sz = sizes[n]
+    if sz == 3:
+      fmt += "HB"
+      split24.append(n)
+    elif sz in _size_codes:
+      fmt += _size_codes[sz]
+    else:
+      return None
+  mods = tuple(1 << (8 * sz) for sz in sizes)
+  return (struct.Struct(fmt), split24, mods)
+
+def _fixup_args(packer, data):
+  """Wrap negative values into two's complement for the whole tuple and split 24-bit values, giving the argument
+  list for packer's struct. Returns None if data includes payload segments."""
+  st, split24, mods = packer
+  try:
+    args = [d + m if d < 0 else d for d, m in zip(data, mods)]
+  except TypeError: # payload segment
+    return None
+  for pos in reversed(split24):
+    val = args[pos]
+    args[pos:pos+1] = [val & 0xFFFF, val >> 16]
+  return args
+
+def _pack_fixup(packer, data):
+  """Slow half of render_bytes' struct path: packs the fixed-up arguments. Returns None if the values still don't
+  fit (or include payload segments)."""
+  args = _fixup_args(packer, data)
+  if args is None:
+    return None
+  try:
+    return packer[0].pack(*args)
+  except struct.error:
+    return None
+
+def _size_packer(sizes):
+  packer = _size_structs.get(sizes)
+  if packer is None:
+    if len(_size_structs) >= 4096: # variable-length commands produce many signatures
+      _size_structs.clear()
+    packer = _size_struct(sizes) or False
+    _size_structs[sizes] = packer
+  return packer
+
 def render_bytes(ans):
-  ans["bytes"] = []
-  if len(ans["data"])!=len(ans["size"]):
-    ans["log"].append(f'Mismatched length of data({len(ans["data"])}) vs size({len(ans["size"])}). Will not render bytes.')
+  data = ans["data"]
+  if len(data)!=len(ans["size"]):
+    ans["log"].append(f'Mismatched length of data({len(data)}) vs size({len(ans["size"])}). Will not render bytes.')
     ans["bytes"] = b''
+    return ans
+  packer = _size_packer(tuple(ans["size"]))
+  packed = None
+  if packer:
+    if not packer[1]:
+      try:
+        packed = packer[0].pack(*data)
+      except struct.error:
+        packed = _pack_fixup(packer, data)
+    else:
+      packed = _pack_fixup(packer, data)
+  if packed is None:
+    packed = _render_bytes_loop(ans)
+  ans["bytes"] = packed
+  return ans
+
+def _render_into(ans, buf, offset):
+  """render_bytes() writing into buf at offset instead of returning bytes: int fields are packed in place with
+  pack_into and payload segments are copied straight from their buffers. The data and size lists must already
+  have matching lengths."""
+  data = ans["data"]
+  sizes = ans["size"]
+  packer = _size_packer(tuple(sizes))
+  if packer:
+    if not packer[1]:
+      try:
+        packer[0].pack_into(buf, offset, *data)
+        return
+      except struct.error:
+        pass
+    args = _fixup_args(packer, data)
+    if args is not None:
+      try:
+        packer[0].pack_into(buf, offset, *args)
+        return
+      except struct.error:
+        pass
+  if all(type(n) is int for n in data):
+    packed = _render_bytes_loop(ans)
+    buf[offset:offset+len(packed)] = packed
+    return
+  start = 0
+  for n in range(len(data) + 1):
+    if n == len(data) or not (type(data[n]) is int):
+      if start < n:
+        _render_into({"data":data[start:n], "size":sizes[start:n]}, buf, offset)
+        offset += sum(sizes[start:n])
+      if n < len(data):
+        buf[offset:offset+sizes[n]] = data[n]
+        offset += sizes[n]
+      start = n + 1
+
+"""optable maps each VDP-IL command name to its encoder. It is built once at import; use register_command() to add
+experimental or project-specific commands."""
+
+optable = {
+  "vdu_null":vdu_null,
+  "vdu_printernext":vdu_printernext,
+  "vdu_printerenable":vdu_printerenable,
+  "vdu_printerdisable":vdu_printerdisable,
+  "vdu_writetext":vdu_writetext,
+  "vdu_writegraphics":vdu_writegraphics,
+  "vdu_enablescreen":vdu_enablescreen,
+  "vdu_beep":vdu_beep,
+  "vdu_back":vdu_back,
+  "vdu_forward":vdu_forward,
+  "vdu_down":vdu_down,
+  "vdu_up":vdu_up,
+  "vdu_cls":vdu_cls,
+  "vdu_cr":vdu_cr,
+  "vdu_pageon":vdu_pageon,
+  "vdu_pageoff":vdu_pageoff,
+  "vdu_clg":vdu_clg,
+  "vdu_colour":vdu_colour,
+  "vdu_colourmode":vdu_colourmode,
+  "vdu_colourlogical":vdu_colourlogical,
+  "vdu_colourreset":vdu_colourreset,
+  "vdu_screendisable":vdu_screendisable,
+  "vdu_screenmode":vdu_screenmode,
+  "vdu_charredefine":vdu_charredefine,
+  "vdu_cursorcontrol":vdu_cursorcontrol,
+  "vdu_dottedlineredefine":vdu_dottedlineredefine,
+  "vdu_scroll":vdu_scroll,
+  "vdu_cursormovementredefine":vdu_cursormovementredefine,
+  "vdu_linethickness":vdu_linethickness,
+  "vdu_hexload":vdu_hexload,
+  "vdu_graphicsviewport":vdu_graphicsviewport,
+  "vdu_plot":vdu_plot,
+  "vdu_resetviewports":vdu_resetviewports,
+  "vdu_charoutput":vdu_charoutput,
+  "vdu_textviewport":vdu_textviewport,
+  "vdu_graphicsorigin":vdu_graphicsorigin,
+  "vdu_home":vdu_home,
+  "vdu_cursormove":vdu_cursormove,
+  "vdu_backspace":vdu_backspace,
+  "aud_playnote":aud_playnote,
+  "aud_status":aud_status,
+  "aud_set_volume":aud_set_volume,
+  "aud_set_frequency":aud_set_frequency,
+  "aud_set_waveform":aud_set_waveform,
+  "aud_loadsample":aud_loadsample,
+  "aud_clearsample":aud_clearsample,
+  "aud_samplefrombuffer":aud_samplefrombuffer,
+  "aud_set_samplebasefrequency":aud_set_samplebasefrequency,
+  "aud_set_samplebufferbasefrequency":aud_set_samplebufferbasefrequency,
+  "aud_set_samplerepeatstart":aud_set_samplerepeatstart,
+  "aud_set_samplebufferrepeatstart":aud_set_samplebufferrepeatstart,
+  "aud_set_samplerepeatlength":aud_set_samplerepeatlength,
+  "aud_set_samplebufferrepeatlength":aud_set_samplebufferrepeatlength,
+  "aud_disable_envelope":aud_disable_envelope,
+  "aud_adsr":aud_adsr,
+  "aud_multiphase_adsr":aud_multiphase_adsr,
+  "aud_freqenv_off":aud_freqenv_off,
+  "aud_freqenv_stepped":aud_freqenv_stepped,
+  "aud_enable_channel":aud_enable_channel,
+  "aud_disable_channel":aud_disable_channel,
+  "aud_reset_channel":aud_reset_channel,
+  "aud_seek":aud_seek,
+  "aud_set_duration":aud_set_duration,
+  "aud_set_samplerate":aud_set_samplerate,
+  "aud_set_waveform_parameter":aud_set_waveform_parameter,
+  "buf_write_block":buf_write_block,
+  "buf_call":buf_call,
+  "buf_clear":buf_clear,
+  "buf_create_writeable":buf_create_writeable,
+  "buf_set_output_stream":buf_set_output_stream,
+  "buf_adjust_contents":buf_adjust_contents,
+  "buf_condcall":buf_condcall,
+  "buf_jump":buf_jump,
+  "buf_condjump":buf_condjump,
+  "buf_jumpoffset":buf_jumpoffset,
+  "buf_condjumpoffset":buf_condjumpoffset,
+  "buf_condcalloffset":buf_condcalloffset,
+  "buf_copyconcatblocks":buf_copyconcatblocks,
+  "buf_consolidate":buf_consolidate,
+  "buf_split":buf_split,
+  "buf_splitspread":buf_splitspread,
+  "buf_splitspreadid":buf_splitspreadid,
+  "buf_splitwidth":buf_splitwidth,
+  "buf_splitwidthspread":buf_splitwidthspread,
+  "buf_splitspreadwidthid":buf_splitspreadwidthid,
+  "buf_spread":buf_spread,
+  "buf_spreadid":buf_spreadid,
+  "buf_reverseblocks":buf_reverseblocks,
+  "buf_reversedata":buf_reversedata,
+  "buf_copyreference":buf_copyreference,
+  "buf_copyconsolidate":buf_copyconsolidate,
+  "buf_compress":buf_compress,
+  "buf_decompress":buf_decompress,
+  "buf_expandbitmap":buf_expandbitmap,
+  "buf_debug":buf_debug,
+  "sys_terminal":sys_terminal,
+  "sys_consolemode":sys_consolemode,
+  "sys_testflagclear":sys_testflagclear,
+  "sys_testflag":sys_testflag,
+  "sys_dotdashlength":sys_dotdashlength,
+  "sys_logicalscaling":sys_logicalscaling,
+  "sys_updatevdp":sys_updatevdp,
+  "sys_graphicsoriginviewfromcursor":sys_graphicsoriginviewfromcursor,
+  "sys_graphicsoriginfromplot":sys_graphicsoriginfromplot,
+  "sys_graphicsviewportfromplot":sys_graphicsviewportfromplot,
+  "sys_textviewportfromplot":sys_textviewportfromplot,
+  "sys_printbuffer":sys_printbuffer,
+  "sys_controlkeystoggle":sys_controlkeystoggle,
+  "sys_get_palettecolour":sys_get_palettecolour,
+  "sys_get_graphicscode":sys_get_graphicscode,
+  "sys_cursorrelmove":sys_cursorrelmove,
+  "sys_resetsysfont":sys_resetsysfont,
+  "sys_charredefine":sys_charredefine,
+  "sys_charbitmap":sys_charbitmap,
+  "sys_cursorendcol":sys_cursorendcol,
+  "sys_cursorstartcol":sys_cursorstartcol,
+  "sys_mousewheelacceleration":sys_mousewheelacceleration,
+  "sys_mouseacceleration":sys_mouseacceleration,
+  "sys_mousescaling":sys_mousescaling,
+  "sys_mouseresolution":sys_mouseresolution,
+  "sys_mousesamplerate":sys_mousesamplerate,
+  "sys_mouseposition":sys_mouseposition,
+  "sys_mousecursor":sys_mousecursor,
+  "sys_mousereset":sys_mousereset,
+  "sys_mousedisable":sys_mousedisable,
+  "sys_mouseenable":sys_mouseenable,
+  "sys_keyboardctl":sys_keyboardctl,
+  "sys_set_rtc":sys_set_rtc,
+  "sys_get_rtc":sys_get_rtc,
+  "sys_get_screendimensions":sys_get_screendimensions,
+  "sys_get_pixelcolour":sys_get_pixelcolour,
+  "sys_get_textcode":sys_get_textcode,
+  "sys_get_textpos":sys_get_textpos,
+  "sys_keyboardlocale":sys_keyboardlocale,
+  "sys_poll":sys_poll,
+  "sys_cursorend":sys_cursorend,
+  "sys_cursorstart":sys_cursorstart,
+  "mode_logicalscale":mode_logicalscale,
+  "mode_legacy":mode_legacy,
+  "mode_swap":mode_swap,
+  "mode_flush":mode_flush,
+  "bmp_select8":bmp_select8,
+  "bmp_load8":bmp_load8,
+  "bmp_capture8":bmp_capture8,
+  "bmp_makerect":bmp_makerect,
+  "bmp_draw":bmp_draw,
+  "bmp_select16":bmp_select16,
+  "bmp_makefrombuffer":bmp_makefrombuffer,
+  "spr_select":spr_select,
+  "spr_clear":spr_clear,
+  "spr_append8":spr_append8,
+  "spr_activate":spr_activate,
+  "spr_next":spr_next,
+  "spr_prev":spr_prev,
+  "spr_frame":spr_frame,
+  "spr_show":spr_show,
+  "spr_hide":spr_hide,
+  "spr_absmove":spr_absmove,
+  "spr_relmove":spr_relmove,
+  "spr_update":spr_update,
+  "spr_resetall":spr_resetall,
+  "spr_resetspr":spr_resetspr,
+  "spr_gcol":spr_gcol,
+  "spr_append16":spr_append16,
+  "spr_cursor":spr_cursor,
+  "ctx_select":ctx_select,
+  "ctx_delete":ctx_delete,
+  "ctx_reset":ctx_reset,
+  "ctx_save":ctx_save,
+  "ctx_restore":ctx_restore,
+  "ctx_saveselect":ctx_saveselect,
+  "ctx_restoreall":ctx_restoreall,
+  "ctx_clear":ctx_clear,
+  "font_select":font_select,
+  "font_create":font_create,
+  "font_property":font_property,
+  "font_clear":font_clear,
+  "font_copysystem":font_copysystem,
+}
+
+def register_command(name, fn, layout=None):
+  """Register an encoder under a command name, replacing any existing command of that name.
+  fn(config) must return a dict in the same form as the built-in encoders.
+  layout is an optional (data, size) pair in the form used by _fast_layouts, letting render:"fast" pack the
+  command without calling fn."""
+  optable[name] = fn
+  global _decode_trie
+  _fast_compiled.pop(name, None)
+  _decode_trie = None
+  if layout is None:
+    _fast_layouts.pop(name, None)
   else:
-    for n in range(len(ans["data"])):
-      size = ans["size"][n]
-      rawd = ans["data"][n]
-      if (rawd < 0): # negative value handling...perhaps there is a better way of dealing with this
-        if size==1:
-          rawd += 32768
-        elif size==2:
-          rawd += 65536
-        elif size==3:
-          rawd += 16777216
-        elif size==4:
-          rawd += 4294967296
-        else:
-          print(ans["data"])
-          raise Exception("I don't know how to deal with a negative value ("+str(rawd)+") of size "+str(size))
-      ans["bytes"].append(rawd.to_bytes(size, byteorder='little'))
-    ans["bytes"] = b''.join(ans["bytes"])
-  return ans
-
-def process(configs):
-  optable = {
-    "vdu_null":vdu_null,
-    "vdu_printernext":vdu_printernext,
-    "vdu_printerenable":vdu_printerenable,
-    "vdu_printerdisable":vdu_printerdisable,
-    "vdu_writetext":vdu_writetext,
-    "vdu_writegraphics":vdu_writegraphics,
-    "vdu_enablescreen":vdu_enablescreen,
-    "vdu_beep":vdu_beep,
-    "vdu_back":vdu_back,
-    "vdu_forward":vdu_forward,
-    "vdu_down":vdu_down,
-    "vdu_up":vdu_up,
-    "vdu_cls":vdu_cls,
-    "vdu_cr":vdu_cr,
-    "vdu_pageon":vdu_pageon,
-    "vdu_pageoff":vdu_pageoff,
-    "vdu_clg":vdu_clg,
-    "vdu_colour":vdu_colour,
-    "vdu_colourmode":vdu_colourmode,
-    "vdu_colourlogical":vdu_colourlogical,
-    "vdu_colourreset":vdu_colourreset,
-    "vdu_screendisable":vdu_screendisable,
-    "vdu_screenmode":vdu_screenmode,
-    "vdu_charredefine":vdu_charredefine,
-    "vdu_cursorcontrol":vdu_cursorcontrol,
-    "vdu_dottedlineredefine":vdu_dottedlineredefine,
-    "vdu_scroll":vdu_scroll,
-    "vdu_cursormovementredefine":vdu_cursormovementredefine,
-    "vdu_linethickness":vdu_linethickness,
-    "vdu_hexload":vdu_hexload,
-    "vdu_graphicsviewport":vdu_graphicsviewport,
-    "vdu_plot":vdu_plot,
-    "vdu_resetviewports":vdu_resetviewports,
-    "vdu_charoutput":vdu_charoutput,
-    "vdu_textviewport":vdu_textviewport,
-    "vdu_graphicsorigin":vdu_graphicsorigin,
-    "vdu_home":vdu_home,
-    "vdu_cursormove":vdu_cursormove,
-    "vdu_backspace":vdu_backspace,
-    "aud_playnote":aud_playnote,
-    "aud_status":aud_status,
-    "aud_set_volume":aud_set_volume,
-    "aud_set_frequency":aud_set_frequency,
-    "aud_set_waveform":aud_set_waveform,
-    "aud_loadsample":aud_loadsample,
-    "aud_clearsample":aud_clearsample,
-    "aud_samplefrombuffer":aud_samplefrombuffer,
-    "aud_set_samplebasefrequency":aud_set_samplebasefrequency,
-    "aud_set_samplebufferbasefrequency":aud_set_samplebufferbasefrequency,
-    "aud_set_samplerepeatstart":aud_set_samplerepeatstart,
-    "aud_set_samplebufferrepeatstart":aud_set_samplebufferrepeatstart,
-    "aud_set_samplerepeatlength":aud_set_samplerepeatlength,
-    "aud_set_samplebufferrepeatlength":aud_set_samplebufferrepeatlength,
-    "aud_disable_envelope":aud_disable_envelope,
-    "aud_adsr":aud_adsr,
-    "aud_multiphase_adsr":aud_multiphase_adsr,
-    "aud_freqenv_off":aud_freqenv_off,
-    "aud_freqenv_stepped":aud_freqenv_stepped,
-    "aud_enable_channel":aud_enable_channel,
-    "aud_disable_channel":aud_disable_channel,
-    "aud_reset_channel":aud_reset_channel,
-    "aud_seek":aud_seek,
-    "aud_set_duration":aud_set_duration,
-    "aud_set_samplerate":aud_set_samplerate,
-    "aud_set_waveform_parameter":aud_set_waveform_parameter,
-    "buf_write_block":buf_write_block,
-    "buf_call":buf_call,
-    "buf_clear":buf_clear,
-    "buf_create_writeable":buf_create_writeable,
-    "buf_set_output_stream":buf_set_output_stream,
-    "buf_adjust_contents":buf_adjust_contents,
-    "buf_condcall":buf_condcall,
-    "buf_jump":buf_jump,
-    "buf_condjump":buf_condjump,
-    "buf_jumpoffset":buf_jumpoffset,
-    "buf_condjumpoffset":buf_condjumpoffset,
-    "buf_condcall":buf_condcall,
-    "buf_condcalloffset":buf_condcalloffset,
-    "buf_copyconcatblocks":buf_copyconcatblocks,
-    "buf_consolidate":buf_consolidate,
-    "buf_split":buf_split,
-    "buf_splitspread":buf_splitspread,
-    "buf_splitspreadid":buf_splitspreadid,
-    "buf_splitwidth":buf_splitwidth,
-    "buf_splitwidthspread":buf_splitwidthspread,
-    "buf_splitspreadwidthid":buf_splitspreadwidthid,
-    "buf_spread":buf_spread,
-    "buf_spreadid":buf_spreadid,
-    "buf_reverseblocks":buf_reverseblocks,
-    "buf_reversedata":buf_reversedata,
-    "buf_copyreference":buf_copyreference,
-    "buf_copyconsolidate":buf_copyconsolidate,
-    "buf_compress":buf_compress,
-    "buf_decompress":buf_decompress,
-    "buf_expandbitmap":buf_expandbitmap,
-    "buf_debug":buf_debug,
-    "sys_terminal":sys_terminal,
-    "sys_consolemode":sys_consolemode,
-    "sys_testflagclear":sys_testflagclear,
-    "sys_testflag":sys_testflag,
-    "sys_dotdashlength":sys_dotdashlength,
-    "sys_logicalscaling":sys_logicalscaling,
-    "sys_updatevdp":sys_updatevdp,
-    "sys_graphicsoriginviewfromcursor":sys_graphicsoriginviewfromcursor,
-    "sys_graphicsoriginfromplot":sys_graphicsoriginfromplot,
-    "sys_graphicsviewportfromplot":sys_graphicsviewportfromplot,
-    "sys_textviewportfromplot":sys_textviewportfromplot,
-    "sys_printbuffer":sys_printbuffer,
-    "sys_controlkeystoggle":sys_controlkeystoggle,
-    "sys_get_palettecolour":sys_get_palettecolour,
-    "sys_get_graphicscode":sys_get_graphicscode,
-    "sys_cursorrelmove":sys_cursorrelmove,
-    "sys_resetsysfont":sys_resetsysfont,
-    "sys_charredefine":sys_charredefine,
-    "sys_charbitmap":sys_charbitmap,
-    "sys_cursorendcol":sys_cursorendcol,
-    "sys_cursorstartcol":sys_cursorstartcol,
-    "sys_mousewheelacceleration":sys_mousewheelacceleration,
-    "sys_mouseacceleration":sys_mouseacceleration,
-    "sys_mousescaling":sys_mousescaling,
-    "sys_mouseresolution":sys_mouseresolution,
-    "sys_mousesamplerate":sys_mousesamplerate,
-    "sys_mouseposition":sys_mouseposition,
-    "sys_mousecursor":sys_mousecursor,
-    "sys_mousereset":sys_mousereset,
-    "sys_mousedisable":sys_mousedisable,
-    "sys_mouseenable":sys_mouseenable,
-    "sys_keyboardctl":sys_keyboardctl,
-    "sys_set_rtc":sys_set_rtc,
-    "sys_get_rtc":sys_get_rtc,
-    "sys_get_screendimensions":sys_get_screendimensions,
-    "sys_get_pixelcolour":sys_get_pixelcolour,
-    "sys_get_textcode":sys_get_textcode,
-    "sys_get_textpos":sys_get_textpos,
-    "sys_keyboardlocale":sys_keyboardlocale,
-    "sys_poll":sys_poll,
-    "sys_cursorend":sys_cursorend,
-    "sys_cursorstart":sys_cursorstart,
-    "mode_logicalscale":mode_logicalscale,
-    "mode_legacy":mode_legacy,
-    "mode_swap":mode_swap,
-    "mode_flush":mode_flush,
-    "bmp_select8":bmp_select8,
-    "bmp_load8":bmp_load8,
-    "bmp_capture8":bmp_capture8,
-    "bmp_makerect":bmp_makerect,
-    "bmp_draw":bmp_draw,
-    "bmp_select16":bmp_select16,
-    "bmp_makefrombuffer":bmp_makefrombuffer,
-    "spr_select":spr_select,
-    "spr_clear":spr_clear,
-    "spr_append8":spr_append8,
-    "spr_activate":spr_activate,
-    "spr_next":spr_next,
-    "spr_prev":spr_prev,
-    "spr_frame":spr_frame,
-    "spr_show":spr_show,
-    "spr_hide":spr_hide,
-    "spr_absmove":spr_absmove,
-    "spr_relmove":spr_relmove,
-    "spr_update":spr_update,
-    "spr_resetall":spr_resetall,
-    "spr_resetspr":spr_resetspr,
-    "spr_gcol":spr_gcol,
-    "spr_append16":spr_append16,
-    "spr_cursor":spr_cursor,
-    "ctx_select":ctx_select,
-    "ctx_delete":ctx_delete,
-    "ctx_reset":ctx_reset,
-    "ctx_save":ctx_save,
-    "ctx_restore":ctx_restore,
-    "ctx_saveselect":ctx_saveselect,
-    "ctx_restoreall":ctx_restoreall,
-    "ctx_clear":ctx_clear,
-    "font_select":font_select,
-    "font_create":font_create,
-    "font_property":font_property,
-    "font_clear":font_clear,
-    "font_copysystem":font_copysystem,
-  }
+    _fast_layouts[name] = layout
+
+def _canonical(value):
+  """Convert a config (or any value inside it) to a hashable form that compares equal only for configs that
+  encode identically. Lists and tuples are kept distinct, as are bools/floats and ints of equal value.
+  Payloads (bytes-like values) raise TypeError: a cached payload command would hold its payload twice, once in its
+  data and again in its rendered bytes, and encoding one is only a copy anyway."""
+  tv = type(value)
+  if tv is str or tv is int or value is None:
+    return value
+  elif tv is dict:
+    return (dict, tuple(sorted((k, _canonical(v)) for k, v in value.items())))
+  elif tv is list or tv is tuple:
+    return (tv, tuple(_canonical(v) for v in value))
+  elif tv is bytes or tv is bytearray or tv is memoryview:
+    raise TypeError("payloads aren't cached")
+  else:
+    hash(value) # raises TypeError for anything else unhashable
+    return (tv, value)
+
+def _copy_result(na):
+  """Copy an encoder result along with its lists, so a cached entry and the results handed out share none."""
+  ans = dict(na)
+  for k in ("log", "doc", "data", "size", "field"):
+    if k in na:
+      ans[k] = list(na[k])
+  return ans
+
+class EncodeCache(object):
+  def __init__(self, maxsize=4096, enabled=True):
+    """Size-bounded LRU cache of encoded commands, keyed by the canonical form of the config.
+    Pass it to process(), iprocess() or writevdu() as cache=... to skip validation and packing for repeated
+    commands. Set enabled to False (or pass cache=None) to turn it off.
+    Commands carrying a bytes-like payload (buf_write_block and the like) are not cached.
+    A cache hit does not fill in defaults on the config the way a fresh encode does."""
+    from collections import OrderedDict
+    self.entries = OrderedDict()
+    self.maxsize = maxsize
+    self.enabled = enabled
+    self.hits = 0
+    self.misses = 0
+  def key(self, config):
+    """Return the cache key for config, or None if it cannot be cached."""
+    try:
+      return _canonical(config)
+    except TypeError:
+      return None
+  def get(self, key):
+    na = self.entries.get(key)
+    if na is None:
+      self.misses += 1
+      return None
+    self.entries.move_to_end(key)
+    self.hits += 1
+    return _copy_result(na)
+  def put(self, key, na):
+    self.entries[key] = _copy_result(na)
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.maxsize:
+      self.entries.popitem(last=False)
+  def clear(self):
+    self.entries.clear()
+    self.hits = 0
+    self.misses = 0
+  def __repr__(self):
+    return f'<EncodeCache {len(self.entries)}/{self.maxsize} entries, {self.hits} hits, {self.misses} misses>'
+
+def _copy_config(value):
+  """Copy the dicts and lists of a config, which are what the _*_default helpers write into."""
+  if type(value) is dict:
+    return {k:_copy_config(v) for k, v in value.items()}
+  elif type(value) is list:
+    return [_copy_config(v) for v in value]
+  return value
+
+def _fast_valid(config):
+  """True if config has a fixed layout and every field is present, an int and in range, i.e. the encoder would
+  accept it without logging anything."""
+  layout = _fast_layouts.get(config["command"])
+  if layout is None:
+    return False
+  data, size = layout
+  for n in range(len(data)):
+    if type(data[n]) is str:
+      val = config.get(data[n])
+      lo, hi = _fast_ranges[size[n]]
+      if not (type(val) is int) or val < lo or val > hi:
+        return False
+  return True
+
+def _validate_one(n):
+  """Run a config's checks without packing bytes or touching the config. Returns a result dict whose "log" holds
+  the encoder's warnings and "errors" anything that would stop it from rendering."""
+  if isinstance(n, CommandBatch):
+    ans = {"log":[],"doc":[],"errors":[],"command":n.command}
+    try:
+      na, slots = n._layout()
+      log = []
+      for k, pos in slots:
+        n._checked(k, n.columns[k], na["size"][pos], log)
+      ans["log"] = na["log"] + [f'command {idx}: {msg}' for idx, msg in sorted(log, key=lambda x: x[0])]
+    except Exception as e:
+      ans["errors"].append(f'{type(e).__name__}: {e}')
+    return ans
+  ans = {"log":[],"doc":[],"errors":[],"command":n.get("command") if type(n) is dict else None}
+  if not (type(n) is dict) or not ("command" in n):
+    ans["errors"].append("Config is not a dict with a \"command\" field.")
+    return ans
+  if not (n["command"] in optable):
+    ans["errors"].append(f'Unknown command {n["command"]}.')
+    return ans
+  if _fast_valid(n):
+    return ans
+  probe = _copy_config(n)
+  probe["render"] = "validate"
+  probe.pop("fields", None)
+  try:
+    na = optable[n["command"]](probe)
+  except Exception as e:
+    ans["errors"].append(f'{type(e).__name__}: {e}')
+    return ans
+  ans["log"] = na["log"]
+  if "data" in na and len(na["data"]) != len(na["size"]):
+    ans["errors"].append(f'Mismatched length of data({len(na["data"])}) vs size({len(na["size"])}).')
+  return ans
+
+def validate(configs):
+  """Check a list of configs without rendering them, returning a list of diagnostics:
+  {"index":..., "command":..., "severity":"warning"|"error", "message":...}.
+  Warnings are the encoder's log messages (a default was filled in); errors are unknown commands, encoders that
+  raise, and commands that could not be rendered. The configs are not modified."""
   ans = []
+  idx = 0
   for n in configs:
-    na = optable[n["command"]](n)
-    na["command"] = n["command"]
-    if "render" in n:
-      if n["render"] == "bytes":
-        render_bytes(na)
-      elif n["render"] == "offsets":
-        render_offsets(na)
-    ans.append(na)
+    na = _validate_one(n)
+    for msg in na["log"]:
+      ans.append({"index":idx,"command":na["command"],"severity":"warning","message":msg})
+    for msg in na["errors"]:
+      ans.append({"index":idx,"command":na["command"],"severity":"error","message":msg})
+    idx += 1
   return ans
 
+def _process_one(n, cache=None):
+  if isinstance(n, CommandBatch):
+    return n.render()
+  if n.get("render") == "validate":
+    return _validate_one(n)
+  if cache is not None and cache.enabled:
+    key = cache.key(n)
+    if key is not None:
+      na = cache.get(key)
+      if na is None:
+        na = _process_one(n)
+        cache.put(key, na)
+      return na
+  if n.get("render") == "fast":
+    packed = render_fast(n)
+    if packed is not None:
+      return {"log":[],"doc":[],"bytes":packed,"command":n["command"]}
+  na = optable[n["command"]](n)
+  na["command"] = n["command"]
+  if "render" in n:
+    if n["render"] == "bytes" or n["render"] == "fast":
+      render_bytes(na)
+    elif n["render"] == "offsets":
+      render_offsets(na)
+  return na
+
+class ProcessStats(object):
+  def __init__(self):
+    """Per-command-type instrumentation for process(), iprocess() and writevdu(): pass stats=ProcessStats() to
+    record, for each command name, how many commands were encoded, the time spent encoding them, the bytes they
+    produced, how many needed a fallback (a field was missing or invalid and a default was filled in, i.e. the
+    command logged something) and how many render:"fast" commands had to go through their encoder.
+    With stats=None nothing is timed or counted."""
+    self.commands = {}
+  def record(self, command, seconds, nbytes, fallbacks=0, slowpath=0, count=1):
+    entry = self.commands.get(command)
+    if entry is None:
+      entry = {"count":0, "seconds":0.0, "bytes":0, "fallbacks":0, "slowpath":0}
+      self.commands[command] = entry
+    entry["count"] += count
+    entry["seconds"] += seconds
+    entry["bytes"] += nbytes
+    entry["fallbacks"] += fallbacks
+    entry["slowpath"] += slowpath
+  def add(self, config, na, seconds):
+    """Record one process() result na for config."""
+    if isinstance(config, CommandBatch):
+      self.record(config.command, seconds, len(na["bytes"]), 1 if na["log"] else 0, 0, na["count"])
+      return
+    slowpath = 1 if config.get("render") == "fast" and "data" in na else 0
+    self.record(na.get("command"), seconds, len(na.get("bytes", b'')), 1 if na["log"] else 0, slowpath)
+  def totals(self):
+    ans = {"count":0, "seconds":0.0, "bytes":0, "fallbacks":0, "slowpath":0}
+    for entry in self.commands.values():
+      for k in ans:
+        ans[k] += entry[k]
+    return ans
+  def merge(self, other):
+    for command, entry in other.commands.items():
+      self.record(command, entry["seconds"], entry["bytes"], entry["fallbacks"], entry["slowpath"], entry["count"])
+  def clear(self):
+    self.commands.clear()
+  def as_dict(self):
+    return {"commands":{k:dict(v) for k, v in self.commands.items()}, "totals":self.totals()}
+  def to_json(self, **kwargs):
+    import json
+    return json.dumps(self.as_dict(), **kwargs)
+  def report(self, sort="bytes", limit=None):
+    """Return a text table, one row per command type, sorted by "bytes", "seconds" or "count" (largest first)."""
+    rows = sorted(self.commands.items(), key=lambda kv: -kv[1][sort])
+    if limit is not None:
+      rows = rows[:limit]
+    totals = self.totals()
+    width = max([len(str(k)) for k, v in rows] + [5])
+    lines = [f'{"command":<{width}} {"count":>8} {"bytes":>10} {"bytes%":>6} {"ms":>9} {"us/cmd":>7} {"fallback":>8} {"slow":>6}']
+    for k, v in rows + [("total", totals)]:
+      share = 100.0 * v["bytes"] / totals["bytes"] if totals["bytes"] else 0.0
+      per = 1e6 * v["seconds"] / v["count"] if v["count"] else 0.0
+      lines.append(f'{str(k):<{width}} {v["count"]:8d} {v["bytes"]:10d} {share:6.1f} {v["seconds"]*1000:9.2f} ' +
+        f'{per:7.2f} {v["fallbacks"]:8d} {v["slowpath"]:6d}')
+    return "\n".join(lines)
+  def __repr__(self):
+    t = self.totals()
+    return f'<ProcessStats {len(self.commands)} command types, {t["count"]} commands, {t["bytes"]} bytes, {t["seconds"]*1000:.1f} ms>'
+
+def iprocess(configs, cache=None, stats=None):
+  """Generator version of process(): encodes each config as it is pulled, so configs can itself be a generator
+  and only one command's result needs to be alive at a time."""
+  if stats is None:
+    for n in configs:
+      yield _process_one(n, cache)
+    return
+  from time import perf_counter
+  for n in configs:
+    t0 = perf_counter()
+    na = _process_one(n, cache)
+    stats.add(n, na, perf_counter() - t0)
+    yield na
+
+def process(configs, cache=None, stats=None):
+  """Encode a list of configs, returning one result dict per config.
+  cache is an optional EncodeCache used to reuse results for repeated configs; stats an optional ProcessStats."""
+  if stats is not None:
+    return [n for n in iprocess(configs, cache, stats)]
+  return [_process_one(n, cache) for n in configs]
+
+def _process_worker_init(table, layouts):
+  optable.update(table)
+  _fast_layouts.clear()
+  _fast_layouts.update(layouts)
+  _fast_compiled.clear()
+
+def _shippable(value):
+  """Copy a config like _copy_config, turning memoryview payloads into bytes so it can be pickled."""
+  if type(value) is dict:
+    return {k:_shippable(v) for k, v in value.items()}
+  elif type(value) is list:
+    return [_shippable(v) for v in value]
+  elif type(value) is memoryview:
+    return value.tobytes()
+  return value
+
+def _process_rendered(configs):
+  """process() a chunk of configs, keeping only what process_parallel returns: the bytes and the log."""
+  return [{"bytes":bytes(n["bytes"]), "log":n["log"]} for n in process(configs)]
+
+def process_parallel(configs, workers=None, chunksize=None):
+  """Process configs across a pool of worker processes. Returns, in order, one {"bytes":..., "log":...} dict per
+  config, the rendered bytes and log of what process() would return; the rest of each result (data, size, field) is
+  not sent back from the workers.
+  The list is sharded into chunks of chunksize configs (by default about four chunks per worker, at least 256
+  configs each) and results are reassembled in the original order.
+  Configs are copied (memoryview payloads become bytes), so unlike process() the caller's configs are not filled
+  in with defaults, whether or not the pool is used.
+  Commands added with register_command() are passed on to the workers; their encoders must be picklable
+  (module-level functions)."""
+  import os
+  from concurrent.futures import ProcessPoolExecutor
+  configs = [_shippable(n) for n in configs]
+  if workers is None:
+    workers = os.cpu_count() or 1
+  if chunksize is None:
+    chunksize = max(256, -(-len(configs) // (workers * 4)))
+  if workers <= 1 or len(configs) <= chunksize:
+    return _process_rendered(configs)
+  chunks = [configs[idx:idx+chunksize] for idx in range(0, len(configs), chunksize)]
+  ans = []
+  with ProcessPoolExecutor(max_workers=workers, initializer=_process_worker_init,
+    initargs=(optable, _fast_layouts)) as pool:
+    for result in pool.map(_process_rendered, chunks):
+      ans += result
+  return ans
+
+class CommandBatch(object):
+  def __init__(self, command, columns, config=None):
+    """A run of N commands of the same type, given as columns of field values instead of N configs.
+    columns maps field names to equal-length sequences of ints (NumPy arrays, array.array or lists); config
+    holds the fields shared by every command, e.g. {"style":"solid_ab","action":"plot_abs_fg"} for vdu_plot.
+    render() packs all N commands in one pass, matching the bytes of N configs run through process().
+    A CommandBatch may also be placed in the command list given to process(), iprocess() or writevdu(), where it
+    produces a single result for the whole run."""
+    self.command = command
+    self.columns = columns
+    self.config = config or {}
+    self.count = None
+    for k in columns:
+      if self.count is None:
+        self.count = len(columns[k])
+      elif len(columns[k]) != self.count:
+        raise Exception(f'CommandBatch column {k} has {len(columns[k])} values, expected {self.count}')
+    if self.count is None:
+      raise Exception('CommandBatch needs at least one column')
+  def __repr__(self):
+    return f'<CommandBatch {self.command} x{self.count} ({", ".join(self.columns)})>'
+  def _layout(self):
+    """Encode the shared config once and find where each column lands in the data list.
+    Each column must be a single integer field whose value is copied straight into the output."""
+    def probe(val):
+      config = dict(self.config)
+      for k in self.columns:
+        config[k] = val
+      config["render"] = "bytes"
+      return optable[self.command](config)
+    na = probe(1)
+    other = probe(2)
+    if len(na["data"]) != len(na["size"]) or other["size"] != na["size"]:
+      raise Exception(f'{self.command} does not have a fixed layout and can\'t be batched')
+    slots = []
+    for k in self.columns:
+      pos = [n for n in range(len(na["field"])) if na["field"][n] == k]
+      if len(pos) != 1 or na["data"][pos[0]] != 1 or other["data"][pos[0]] != 2:
+        raise Exception(f'field {k} of {self.command} can\'t be batched')
+      slots.append((k, pos[0]))
+    columns = set(n for k, n in slots)
+    for n in range(len(na["data"])):
+      if not (n in columns) and na["data"][n] != other["data"][n]:
+        raise Exception(f'{self.command} changes with the batched fields and can\'t be batched')
+    return na, slots
+  def _checked(self, name, values, size, log):
+    """Range-check one column the way _u8_default/_u16_default/... would, zeroing values that are out of range.
+    Returns the column with negative values wrapped to two's complement."""
+    lo, hi = _fast_ranges[size]
+    mod = 1 << (8 * size)
+    np = None
+    if type(values).__module__ == 'numpy':
+      import numpy as np
+      if values.dtype.kind not in 'iub':
+        # floats, objects...: check each value the way the encoder would rather than letting a cast truncate them
+        np = None
+        values = values.tolist()
+    if np is not None:
+      values = np.asarray(values, dtype=np.int64)
+      bad = np.nonzero((values < lo) | (values > hi))[0]
+      for idx in bad.tolist():
+        log.append((idx, f'int type in u{size*8} {name} out of range({int(values[idx])}), filling in with zero.'))
+      if len(bad):
+        values = values.copy()
+        values[bad] = 0
+      return np.where(values < 0, values + mod, values)
+    values = list(values)
+    for idx in range(len(values)):
+      if not (type(values[idx]) is int):
+        log.append((idx, f'int type in u{size*8} {name} missing, filling in with zero.'))
+        values[idx] = 0
+    if values and (min(values) < lo or max(values) > hi):
+      for idx in range(len(values)):
+        if values[idx] < lo or values[idx] > hi:
+          log.append((idx, f'int type in u{size*8} {name} out of range({values[idx]}), filling in with zero.'))
+          values[idx] = 0
+    if values and min(values) < 0:
+      values = [v + mod if v < 0 else v for v in values]
+    return values
+  def render(self):
+    """Pack all commands, returning a result dict with "bytes" for the whole run and "log" for its warnings
+    (prefixed with the index of the command they belong to)."""
+    na, slots = self._layout()
+    sizes = na["size"]
+    log = []
+    columns = {}
+    for k, pos in slots:
+      columns[pos] = self._checked(k, self.columns[k], sizes[pos], log)
+    log.sort(key=lambda x: x[0])
+    ans = {"log":[f'command {idx}: {msg}' for idx, msg in log],"doc":[],"command":self.command,"count":self.count}
+    ans["log"] = [f'{msg} (all {self.count} commands)' for msg in na["log"]] + ans["log"]
+    anynumpy = any(type(c).__module__ == 'numpy' for c in columns.values())
+    if anynumpy:
+      ans["bytes"] = self._pack_numpy(na["data"], sizes, columns)
+    else:
+      ans["bytes"] = self._pack_struct(na["data"], sizes, columns)
+    return ans
+  def _pack_struct(self, data, sizes, columns):
+    import itertools
+    st = _size_struct(tuple(sizes))
+    if st is None:
+      raise Exception(f'{self.command} has sizes that can\'t be batched: {sizes}')
+    st = st[0]
+    args = []
+    for n in range(len(data)):
+      col = columns.get(n)
+      if sizes[n] == 3:
+        if col is None:
+          args += [itertools.repeat(data[n] & 0xFFFF), itertools.repeat((data[n] % 0x1000000) >> 16)]
+        else:
+          args += [[v & 0xFFFF for v in col], [v >> 16 for v in col]]
+      elif col is None:
+        args.append(itertools.repeat(data[n] % (1 << (8 * sizes[n]))))
+      else:
+        args.append(col)
+    return b''.join(map(st.pack, *args))
+  def _pack_numpy(self, data, sizes, columns):
+    import numpy as np
+    codes = {1:'<u1', 2:'<u2', 4:'<u4'}
+    dtype = []
+    for n in range(len(data)):
+      if sizes[n] == 3:
+        dtype += [(f'f{n}', '<u2'), (f'f{n}h', '<u1')]
+      else:
+        dtype.append((f'f{n}', codes[sizes[n]]))
+    out = np.empty(self.count, dtype=np.dtype(dtype))
+    for n in range(len(data)):
+      col = columns.get(n)
+      if col is None:
+        col = data[n] % (1 << (8 * sizes[n]))
+      if sizes[n] == 3:
+        out[f'f{n}'] = np.bitwise_and(col, 0xFFFF)
+        out[f'f{n}h'] = np.right_shift(col, 16)
+      else:
+        out[f'f{n}'] = col
+    return out.tobytes()
+
+"""Decoding turns a VDU byte stream back into VDP-IL configs. Commands are recognised by walking a prefix trie built
+from the headers in _fast_layouts and _decode_layouts: each layout contributes its elements up to the last
+constant, with field positions in the header (the audio channel, the buffer id) stepped over by size. Exact bytes
+take priority over field positions, and the deepest command reached wins. Fixed layouts are unpacked with the same
+compiled struct render:"fast" uses; the variable-length commands below unpack their header the same way and read
+the rest of the command with a tail function. A run of the same fixed command (sys_charbitmap over a font, a column
+of bmp_draw) is checked a column of constant bytes at a time and unpacked with iter_unpack instead of walking the
+trie per command."""
+
+def _decode_blocklist(fieldname):
+  def tail(buf, pos, end, config):
+    blocks = []
+    while pos + 2 <= end:
+      n = buf[pos] | (buf[pos+1] << 8)
+      pos += 2
+      if n == 65535:
+        config[fieldname] = blocks
+        return pos
+      blocks.append(n)
+    return None
+  return tail
+
+def _decode_writeblock(buf, pos, end, config):
+  if pos + 2 > end:
+    return None
+  length = buf[pos] | (buf[pos+1] << 8)
+  pos += 2
+  if pos + length > end:
+    return None
+  config["buffer"] = buf[pos:pos+length]
+  return pos + length
+
+def _decode_loadsample(buf, pos, end, config):
+  if pos + 3 > end:
+    return None
+  length = buf[pos] | (buf[pos+1] << 8) | (buf[pos+2] << 16)
+  pos += 3
+  if pos + length > end:
+    return None
+  config["sample"] = buf[pos:pos+length]
+  return pos + length
+
+def _decode_load8(buf, pos, end, config):
+  length = config["w"] * config["h"]
+  if pos + length > end:
+    return None
+  config["data"] = buf[pos:pos+length]
+  return pos + length
+
+def _decode_waveform(buf, pos, end, config):
+  if pos + 1 > end:
+    return None
+  waveform = buf[pos]
+  if waveform >= len(_waveforms) or _waveforms[waveform] is None:
+    return None
+  config["waveform"] = _waveforms[waveform]
+  pos += 1
+  if waveform == 8:
+    if pos + 2 > end:
+      return None
+    config["bufferid"] = buf[pos] | (buf[pos+1] << 8)
+    pos += 2
+  return pos
+
+def _decode_samplefrombuffer(buf, pos, end, config):
+  if pos + 1 > end:
+    return None
+  opt = buf[pos]
+  pos += 1
+  config["format"] = ["unsigned8", "signed8"][opt & 1]
+  if opt & 8:
+    if pos + 2 > end:
+      return None
+    config["samplerate"] = buf[pos] | (buf[pos+1] << 8)
+    pos += 2
+  if opt & 16:
+    config["sampletuning"] = True
+  return pos
+
+def _decode_multiphase(buf, pos, end, config):
+  for fieldname in ("attack", "sustain", "release"):
+    if pos + 1 > end:
+      return None
+    count = buf[pos]
+    pos += 1
+    if pos + count * 3 > end:
+      return None
+    phases = []
+    for n in range(count):
+      phases.append((buf[pos], buf[pos+1] | (buf[pos+2] << 8)))
+      pos += 3
+    config[fieldname] = phases
+  return pos
+
+def _decode_freqenv_stepped(buf, pos, end, config):
+  if pos + 4 > end:
+    return None
+  count = buf[pos]
+  control = buf[pos+1]
+  config["control"] = [name for name, bit in (("repeats", 1), ("cumulative", 2), ("restrict", 4)) if control & bit]
+  config["steplength"] = buf[pos+2] | (buf[pos+3] << 8)
+  pos += 4
+  if pos + count * 4 > end:
+    return None
+  phases = []
+  for n in range(count):
+    phases.append((buf[pos] | (buf[pos+1] << 8), buf[pos+2] | (buf[pos+3] << 8)))
+    pos += 4
+  config["phases"] = phases
+  return pos
+
+def _decode_waveform_parameter(buf, pos, end, config):
+  if pos + 1 > end:
+    return None
+  param = buf[pos]
+  pos += 1
+  if not (param & 0x7F) in (0, 2, 3):
+    return None
+  config["parameter"] = {0:"duty", 2:"volume", 3:"frequency"}[param & 0x7F]
+  if param & 0x80:
+    if pos + 2 > end:
+      return None
+    config["value16"] = buf[pos] | (buf[pos+1] << 8)
+    return pos + 2
+  if pos + 1 > end:
+    return None
+  config["value"] = buf[pos]
+  return pos + 1
+
+def _decode_select(fieldname, strings, codes=None, mask=0xFF):
+  def tail(buf, pos, end, config):
+    if pos + 1 > end:
+      return None
+    code = buf[pos] & mask
+    if codes is not None:
+      if not code in codes:
+        return None
+      code = codes.index(code)
+    if code >= len(strings) or strings[code] is None:
+      return None
+    config[fieldname] = strings[code]
+    return pos + 1
+  return tail
+
+def _decode_flags(fieldname, strings):
+  def tail(buf, pos, end, config):
+    if pos + 1 > end:
+      return None
+    config[fieldname] = [strings[n] for n in range(len(strings)) if buf[pos] & (1 << n)]
+    return pos + 1
+  return tail
+
+def _decode_plot(buf, pos, end, config):
+  if pos + 5 > end:
+    return None
+  code = buf[pos]
+  if not (code & 0xF8) in _plot_style_codes:
+    return None
+  config["style"] = _plot_styles[_plot_style_codes.index(code & 0xF8)]
+  config["action"] = _plot_actions[code & 7]
+  config["x"] = buf[pos+1] | (buf[pos+2] << 8)
+  config["y"] = buf[pos+3] | (buf[pos+4] << 8)
+  return pos + 5
+
+def _decode_expandbitmap(buf, pos, end, config):
+  if pos + 3 > end:
+    return None
+  opt = buf[pos]
+  bits = opt & 7 or 8
+  config["bits"] = bits
+  config["sourceid"] = buf[pos+1] | (buf[pos+2] << 8)
+  pos += 3
+  if opt & 0x08:
+    if pos + 2 > end:
+      return None
+    config["width"] = buf[pos] | (buf[pos+1] << 8)
+    pos += 2
+  if opt & 0x10:
+    if pos + 2 > end:
+      return None
+    config["buffermap"] = buf[pos] | (buf[pos+1] << 8)
+    return pos + 2
+  if pos + (1 << bits) > end:
+    return None
+  config["map"] = list(buf[pos:pos+(1 << bits)])
+  return pos + (1 << bits)
+
+def _decode_u16(fieldname):
+  def tail(buf, pos, end, config):
+    if pos + 2 > end:
+      return None
+    config[fieldname] = buf[pos] | (buf[pos+1] << 8)
+    return pos + 2
+  return tail
+
+def _decode_chain(*tails):
+  def tail(buf, pos, end, config):
+    for fn in tails:
+      pos = fn(buf, pos, end, config)
+      if pos is None:
+        return None
+    return pos
+  return tail
+
+"""Variable-length commands, and commands whose fields are mapped through names: the header as a (data, size)
+layout, followed by the function that reads the rest. Each reproduces what the encoder of the same name emits."""
+
+_decode_layouts = {
+  "vdu_plot": ([25], [1], _decode_plot),
+  "aud_set_waveform": ([23, 0, 0x85, 'channel', 4], [1, 1, 1, 1, 1], _decode_waveform),
+  "aud_loadsample": ([23, 0, 0x85, 'channel', 5, 0], [1, 1, 1, 1, 1, 1], _decode_loadsample),
+  "aud_samplefrombuffer": ([23, 0, 0x85, 'channel', 5, 2, 'bufferid'], [1, 1, 1, 1, 1, 1, 2], _decode_samplefrombuffer),
+  "aud_multiphase_adsr": ([23, 0, 0x85, 'channel', 6, 2], [1, 1, 1, 1, 1, 1], _decode_multiphase),
+  "aud_freqenv_stepped": ([23, 0, 0x85, 'channel', 7, 1], [1, 1, 1, 1, 1, 1], _decode_freqenv_stepped),
+  "aud_set_waveform_parameter": ([23, 0, 0x85, 'channel', 14], [1, 1, 1, 1, 1], _decode_waveform_parameter),
+  "buf_write_block": ([23, 0, 0xA0, 'bufferid', 0], [1, 1, 1, 2, 1], _decode_writeblock),
+  "buf_copyconcatblocks": ([23, 0, 0xA0, 'targetbuffer', 13], [1, 1, 1, 2, 1], _decode_blocklist("sourcebuffer")),
+  "buf_splitspread": ([23, 0, 0xA0, 'bufferid', 16, 'blocksize'], [1, 1, 1, 2, 1, 2], _decode_blocklist("targetbuffer")),
+  "buf_spread": ([23, 0, 0xA0, 'bufferid', 21], [1, 1, 1, 2, 1], _decode_blocklist("targetbuffer")),
+  "buf_copyreference": ([23, 0, 0xA0, 'targetbuffer', 25], [1, 1, 1, 2, 1], _decode_blocklist("sourcebuffer")),
+  "buf_copyconsolidate": ([23, 0, 0xA0, 'targetbuffer', 26], [1, 1, 1, 2, 1], _decode_blocklist("sourcebuffer")),
+  "buf_expandbitmap": ([23, 0, 0xA0, 'targetid', 72], [1, 1, 1, 2, 1], _decode_expandbitmap),
+  "bmp_load8": ([23, 27, 1, 'w', 'h'], [1, 1, 1, 1, 1], _decode_load8),
+  "bmp_makefrombuffer": ([23, 27, 0x21, 'w', 'h'], [1, 1, 1, 2, 2], _decode_select("format", _bitmap_formats)),
+  "font_select": ([23, 0, 0x95, 0, 'bufferid'], [1, 1, 1, 1, 2], _decode_flags("flags", _font_flags)),
+  "font_property": ([23, 0, 0x95, 2, 'bufferid'], [1, 1, 1, 1, 2],
+    _decode_chain(_decode_select("field", _font_fields), _decode_u16("value"))),
+}
+
+_decode_trie = None
+
+def _decode_insert(trie, data, size, spec):
+  """Trie nodes are [children by byte value, field size to step over, node after the field, spec]."""
+  last = max([n for n in range(len(data)) if type(data[n]) is not str], default=-1)
+  node = trie
+  for n in range(last + 1):
+    if type(data[n]) is str:
+      if node[2] is None:
+        node[1] = size[n]
+        node[2] = [{}, 0, None, None]
+      elif node[1] != size[n]:
+        return False
+      node = node[2]
+    else:
+      val = data[n] % (1 << (8 * size[n]))
+      for b in range(size[n]):
+        node = node[0].setdefault((val >> (8 * b)) & 0xFF, [{}, 0, None, None])
+  if node[3] is not None:
+    return False
+  node[3] = spec
+  return True
+
+def _decode_build():
+  """Build the prefix trie from the fixed and variable layouts. Where two layouts share a header the first one
+  inserted keeps it (e.g. sys_logicalscaling and mode_logicalscale encode identically)."""
+  trie = [{}, 0, None, None]
+  for name in _decode_layouts:
+    if name in optable:
+      data, size, tail = _decode_layouts[name]
+      st, template, slots = _compile_layout(data, size)
+      _decode_insert(trie, data, size, (name, st, slots, tail, None))
+  for name in _fast_layouts:
+    if name in optable and not name in _decode_layouts:
+      data, size = _fast_layouts[name]
+      st, template, slots = _compile_layout(data, size)
+      _decode_insert(trie, data, size, (name, st, slots, None, None))
+  for name in _fast_layouts:
+    if name in optable and not name in _decode_layouts:
+      _decode_runnable(trie, *_fast_layouts[name])
+  return trie
+
+def _decode_runnable(trie, data, size):
+  """Give a fixed layout's spec the (offset, byte) list of its constant bytes, if every command matching those
+  bytes decodes to it: no field in its header where an exact byte could take the walk elsewhere, and nothing
+  deeper in the trie below it."""
+  last = max([n for n in range(len(data)) if type(data[n]) is not str], default=-1)
+  node = trie
+  checks = []
+  offset = 0
+  for n in range(last + 1):
+    if type(data[n]) is str:
+      if node[0]:
+        return
+      node = node[2]
+    else:
+      val = data[n] % (1 << (8 * size[n]))
+      for b in range(size[n]):
+        byte = (val >> (8 * b)) & 0xFF
+        checks.append((offset + b, bytes([byte])))
+        node = node[0][byte]
+    offset += size[n]
+  spec = node[3]
+  if node[0] or node[2] is not None or spec[1].size != sum(size) or spec[3] is not None:
+    return
+  node[3] = spec[:4] + (checks,)
+
+def _decode_run(spec, view, pos, end):
+  """Decode the commands from pos on that repeat spec's fixed layout. Returns (entries, next position)."""
+  name, st, slots, tail, checks = spec
+  step = st.size
+  count = 0
+  window = 16
+  while True:
+    m = min(window, (end - pos) // step - count)
+    if m <= 0:
+      break
+    base = pos + count * step
+    k = m
+    for offset, byte in checks:
+      column = view[base + offset:base + offset + m * step:step].tobytes()
+      k = min(k, m - len(column.lstrip(byte)))
+      if k == 0:
+        break
+    count += k
+    if k < m:
+      break
+    window *= 4
+  ans = []
+  cur = pos
+  for vals in st.iter_unpack(view[pos:pos + count * step]):
+    config = {"command":name}
+    for fieldname, idx, size, lo, hi, mod in slots:
+      if size == 3:
+        config[fieldname] = vals[idx] | (vals[idx+1] << 16)
+      else:
+        config[fieldname] = vals[idx]
+    ans.append({"offset":cur, "size":step, "config":config})
+    cur += step
+  return (ans, cur)
+
+def _decode_one(trie, buf, pos, end):
+  """Decode the command at pos. Returns (config, next position, spec) or (None, end of the recognised prefix, None)."""
+  node = trie
+  cur = pos
+  spec = None
+  while True:
+    if node[3] is not None:
+      spec = node[3]
+      matched = cur
+    if cur < end:
+      child = node[0].get(buf[cur])
+      if child is not None:
+        node = child
+        cur += 1
+        continue
+    if node[2] is None or cur + node[1] > end:
+      break
+    cur += node[1]
+    node = node[2]
+  if spec is None:
+    return (None, max(cur, pos + 1), None)
+  name, st, slots, tail, checks = spec
+  if pos + st.size > end:
+    return (None, matched, None)
+  vals = st.unpack_from(buf, pos)
+  config = {"command":name}
+  for fieldname, idx, size, lo, hi, mod in slots:
+    if size == 3:
+      config[fieldname] = vals[idx] | (vals[idx+1] << 16)
+    else:
+      config[fieldname] = vals[idx]
+  nxt = pos + st.size
+  if tail is not None:
+    nxt = tail(buf, nxt, end, config)
+    if nxt is None:
+      return (None, matched, None)
+  return (config, nxt, spec)
+
+def idecode(buf, start=0, end=None):
+  """Decode a VDU byte stream (bytes, bytearray, memoryview or mmap), yielding one dict per command:
+  {"offset":..., "size":..., "config":...}. Payloads such as buf_write_block buffers are memoryview slices
+  of buf, so nothing is copied. Bytes that don't start a recognised command, or a command cut short by the end
+  of the stream, are grouped into {"command":None, "raw":memoryview} configs; decoding resumes after the
+  recognised part of the header."""
+  global _decode_trie
+  if _decode_trie is None:
+    _decode_trie = _decode_build()
+  trie = _decode_trie
+  view = memoryview(buf)
+  if view.format != 'B' or view.ndim != 1:
+    view = view.cast('B')
+  if end is None:
+    end = len(view)
+  pos = start
+  rawstart = None
+  prev = None
+  while pos < end:
+    config, nxt, spec = _decode_one(trie, view, pos, end)
+    if config is None:
+      if rawstart is None:
+        rawstart = pos
+    else:
+      if rawstart is not None:
+        yield {"offset":rawstart, "size":pos-rawstart, "config":{"command":None, "raw":view[rawstart:pos]}}
+        rawstart = None
+      yield {"offset":pos, "size":nxt-pos, "config":config}
+      if spec is prev and spec[4] is not None:
+        run, nxt = _decode_run(spec, view, nxt, end)
+        yield from run
+    prev = spec
+    pos = nxt
+  if rawstart is not None:
+    yield {"offset":rawstart, "size":pos-rawstart, "config":{"command":None, "raw":view[rawstart:pos]}}
+
+def decode(buf, start=0, end=None):
+  return [n for n in idecode(buf, start, end)]
+
+def idecode_file(path):
+  """idecode() over a memory-mapped file, so large streams are paged in as they are walked rather than read
+  into memory. Payload slices keep the mapping alive until they are released."""
+  import mmap
+  import os
+  with open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    yield from idecode(mm)
+  finally:
+    try:
+      mm.close()
+    except BufferError:
+      pass
+
+def disassemble(buf):
+  """Return a text listing of a VDU byte stream: offset, size, command and fields, one command per line.
+  Payloads are shown by length."""
+  ans = []
+  for n in idecode(buf):
+    config = n["config"]
+    fields = []
+    for k in config:
+      if k == "command":
+        continue
+      v = config[k]
+      if isinstance(v, memoryview):
+        v = f'<{len(v)} bytes>'
+      fields.append(f'{k}={v}')
+    ans.append(f'{n["offset"]:08x} {n["size"]:6d} {config["command"] or "?"} ' + " ".join(fields))
+  return "\n".join(ans)
+
+class TransferReport(object):
+  def __init__(self, source, baud=1152000, assets=None, bits_per_byte=10, flag=0.10, top=10):
+    """Size and wire-time budget for a command stream. source is process() output, a bytes-like .vdu image, or the
+    path of a .vdu file (decoded with idecode_file). Bytes are broken down by command family (the name prefix: buf,
+    bmp, aud, vdu, ...), by buffer id (the bufferid or targetbuffer field of buffer commands) and by asset, where
+    assets maps buffer ids to names, either as a dict or a VDPBufferAllocator whose stored search ids are used.
+    Wire time assumes bits_per_byte bits per byte at baud (10 for 8N1). Groups holding more than flag of the total
+    bytes are flagged, and the top largest single commands are kept."""
+    import heapq
+    if isinstance(assets, VDPBufferAllocator):
+      assets = {k:v[0] for k, v in assets.stores.items()}
+    self.baud = baud
+    self.bits_per_byte = bits_per_byte
+    self.flag = flag
+    self.total = 0
+    self.count = 0
+    self.families = {}
+    self.buffers = {}
+    self.assets = {}
+    largest = []
+    for idx, config, size in self._walk(source):
+      command = config["command"] or "raw"
+      self.total += size
+      self.count += 1
+      family = command.split("_")[0] if "_" in command else command
+      self._add(self.families, family, size)
+      bufferid = config.get("bufferid", config.get("targetbuffer")) if command.startswith("buf_") else None
+      if bufferid is not None:
+        self._add(self.buffers, bufferid, size)
+        if assets is not None:
+          self._add(self.assets, assets.get(bufferid, "(unassigned)"), size)
+      entry = (size, -idx, command, bufferid)
+      if len(largest) < top:
+        heapq.heappush(largest, entry)
+      elif size > largest[0][0]:
+        heapq.heapreplace(largest, entry)
+    self.largest = [{"index":-n[1], "command":n[2], "bufferid":n[3], "bytes":n[0], "seconds":self.seconds(n[0])}
+      for n in sorted(largest, reverse=True)]
+  def _walk(self, source):
+    """Yield (index, config, size) for each command in source."""
+    import os
+    if isinstance(source, (str, os.PathLike)):
+      for idx, n in enumerate(idecode_file(source)):
+        yield (idx, n["config"], n["size"])
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+      for idx, n in enumerate(idecode(source)):
+        yield (idx, n["config"], n["size"])
+    else:
+      for idx, na in enumerate(source):
+        data = na.get("bytes", b'')
+        config = {"command":na.get("command")}
+        if config["command"] is not None and config["command"].startswith("buf_") and data:
+          decoded = decode(data)
+          if decoded and decoded[0]["config"]["command"] is not None:
+            config = decoded[0]["config"]
+        yield (idx, config, len(data))
+  def _add(self, table, key, size):
+    entry = table.get(key)
+    if entry is None:
+      entry = {"bytes":0, "count":0}
+      table[key] = entry
+    entry["bytes"] += size
+    entry["count"] += 1
+  def seconds(self, nbytes):
+    """Estimated time to send nbytes at the report's baud rate."""
+    return nbytes * self.bits_per_byte / self.baud
+  def _group(self, table):
+    ans = []
+    for key, entry in sorted(table.items(), key=lambda kv: -kv[1]["bytes"]):
+      share = entry["bytes"] / self.total if self.total else 0.0
+      ans.append({"key":key, "bytes":entry["bytes"], "count":entry["count"], "seconds":self.seconds(entry["bytes"]),
+        "share":share, "flagged":share > self.flag})
+    return ans
+  def as_dict(self):
+    return {"bytes":self.total, "count":self.count, "baud":self.baud, "seconds":self.seconds(self.total),
+      "families":self._group(self.families), "buffers":self._group(self.buffers), "assets":self._group(self.assets),
+      "largest":self.largest}
+  def report(self, limit=10):
+    """Return a text report: totals, then each breakdown (largest first, flagged rows marked with *), then the
+    largest single commands."""
+    lines = [f'{self.total} bytes in {self.count} commands, {self.seconds(self.total):.3f}s at {self.baud} baud']
+    for title, table in (("family", self.families), ("buffer", self.buffers), ("asset", self.assets)):
+      rows = self._group(table)
+      if not rows:
+        continue
+      lines.append(f'by {title}:')
+      for row in rows[:limit]:
+        mark = "*" if row["flagged"] else " "
+        lines.append(f' {mark}{str(row["key"]):<20} {row["bytes"]:10d} {100*row["share"]:6.1f}% {row["seconds"]:9.4f}s {row["count"]:6d} cmds')
+      if len(rows) > limit:
+        lines.append(f'  ... {len(rows) - limit} more')
+    if self.largest:
+      lines.append("largest commands:")
+      for n in self.largest:
+        buf = f' buffer {n["bufferid"]}' if n["bufferid"] is not None else ""
+        lines.append(f'  #{n["index"]:<7} {n["command"]:<26} {n["bytes"]:10d} {n["seconds"]:9.4f}s{buf}')
+    return "\n".join(lines)
+  def __repr__(self):
+    return f'<TransferReport {self.total} bytes, {self.seconds(self.total):.3f}s at {self.baud} baud>'
+
 def bytesize_of_bformat_line(bformat, line_width):
   """Returns the size(in bytes) of the indicated line width in the indicated format. FIXME unused""" 
   if bformat == "RGBA8888":
@@ -2915,51 +4245,134 @@ def bytesize_of_bformat_line(bformat, line_width):
     return None
 
 class PreparedBitmap(object):
-  def __init__(self, img, bformat, x, y, bufferid, attach=[], blocksize=65535):
+  def __init__(self, img, bformat, x, y, bufferid, attach=[], blocksize=65535, packed=None):
     """Takes a PIL/Pillow image, bitmapformat string(e.g. "RGBA2222"), x, y, bufferid, blocksize as input.
     This is an asset definition that helps describe more of the properties of a bitmap before it's broken down into commands.
     x and y values may be used as offsets for large/composited images.
     If x and y will be reassigned later, their values may be ignored; 
+    The image is reduced to the Agon's 64 colours and packed in bformat once, here; only the packed bytes are kept,
+    in self.data. packed is an optional (w, h, data) triple of pixels that are already packed, as splitImage makes
+    from a whole sheet, in which case img is ignored.
     """
-    self.img = PreparedBitmap.downcolor(img)
+    if packed is None:
+      self.w = img.width
+      self.h = img.height
+      self.data = PreparedBitmap.pack(img, bformat)
+    else:
+      self.w, self.h, self.data = packed
     self.x = x
     self.y = y
-    self.w = img.width
-    self.h = img.height
     self.attach = attach
     self.bufferid = bufferid
     self.bformat = bformat
     self.blocksize = blocksize
+    self.alias = None
   def __repr__(self):
-    return f'<PreparedBitmap #{self.bufferid} {self.bformat} ({self.x} {self.y} {self.w} {self.h} {self.attach})>'
+    alias = '' if self.alias is None else f' = #{self.alias.bufferid}'
+    return f'<PreparedBitmap #{self.bufferid}{alias} {self.bformat} ({self.x} {self.y} {self.w} {self.h} {self.attach})>'
+  def bitmapid(self):
+    """The bufferid the pixels are uploaded to: this bitmap's own, or that of the identical bitmap it is an alias of."""
+    if self.alias is None:
+      return self.bufferid
+    return self.alias.bufferid
+  def indexed(self):
+    """The palette form of an RGBA2222 bitmap of at most 16 colours, for upload through buf_expandbitmap, or None.
+    Returns a dict of "bits" (1, 2 or 4: the fewest that give every colour an index), "map" (the 2**bits colours
+    the indices stand for), "data" (the indices, packed most significant bits first) and "width": the bitmap's
+    width if its rows had to be padded to start on a byte boundary, otherwise None."""
+    if self.bformat != "RGBA2222" or not self.data:
+      return None
+    colours = sorted(set(self.data))
+    if len(colours) > 16:
+      return None
+    bits = 1 if len(colours) <= 2 else 2 if len(colours) <= 4 else 4
+    lut = bytearray(256)
+    for idx, n in enumerate(colours):
+      lut[n] = idx
+    per = 8 // bits
+    return {"bits":bits, "map":colours + [0] * ((1 << bits) - len(colours)),
+      "data":_pack_indices(self.data.translate(lut), self.w, bits), "width":self.w if self.w % per else None}
+  def dedupe(pbitmaps):
+    """Find bitmaps with identical pixels (same format, size and packed bytes). The first of each set is kept; each
+    later copy gets .alias set to it, so that cmd_upload_preparedbitmaps() skips it and the commands that refer to it
+    use the first one's buffer. Returns the remap table: for each bitmap in order, the bufferid holding its pixels."""
+    seen = {}
+    for n in pbitmaps:
+      if n.data is None or n.alias is not None:
+        continue
+      key = (n.bformat, n.w, n.h, n.data)
+      if key in seen:
+        n.alias = seen[key]
+      else:
+        seen[key] = n
+    return [n.bitmapid() for n in pbitmaps]
   def downcolor(img):
     img = img.convert('RGBA')
-    img = img.point(lambda p: p // 85 * 85)
+    img = img.point(list(_downcolor_table) * 4)
     return img
-  def splitImage(img, bformat, start_bufferid, frame=(128,128), mode="tile", origin=None, attach_shared={}, attach_frame={}):
+  def pack(img, bformat):
+    """Downcolor and pack an image in one pass, returning bytes in bformat ("RGBA2222" or "RGBA8888"), or None for
+    formats that can't be packed from an image."""
+    if bformat == "RGBA2222":
+      return quantize_rgba2222(img)
+    elif bformat == "RGBA8888":
+      return rgba8888_bytes(img).translate(_downcolor_table)
+    return None
+  def splitImage(img, bformat, start_bufferid, frame=(128,128), mode="tile", origin=None, attach_shared={}, attach_frame={},
+    workers=None, dedupe=False, packed=None):
     """Splits one large tiled image into multiple by the indicated frame size, and assigns them unique ascending ids.
     In mode=("tile",) the exact size of the tile is preserved and the X and Y values are assigned to their location in
       the original sheet.
     In mode=("trim", originx, originy) the tiles are trimmed by the bounding box determined by alpha value. The
       X and Y values are assigned relative to the provided originx and originy, so that the tiles remain centered if drawn
       using the X and Y adjustments. If the majority of the tiles are uncropped, a warning will be logged to errlog.
+      A fully transparent tile is trimmed to its top-left pixel.
+    The sheet is packed once and each tile is sliced out of the packed bytes; trim boxes come from row and column
+    reductions of the alpha channel, over the whole sheet at once when NumPy is installed.
+    workers > 1 slices the tiles in a pool of threads; the result is the same list, in the same order.
+    dedupe=True runs PreparedBitmap.dedupe() on the tiles, so repeated tiles (e.g. empty ones) are uploaded once.
+    packed is the sheet already run through PreparedBitmap.pack(img, bformat), if the caller has it.
     """
-    import math
     x0 = 0
-    y0 = 0    
-    count = 0
+    y0 = 0
+    boxes = []
+    while y0 + frame[1] <= img.height:
+      boxes.append((x0, y0, min(img.width, x0 + frame[0]), y0 + frame[1]))
+      x0 = x0 + frame[0]
+      if x0 >= img.width:
+        x0 = 0
+        y0 = y0 + frame[1]
     ans = []
     errlog = []
     trimwarning = 0
-    while y0 + frame[0] <= img.height:
-      x1 = min(img.width, x0 + frame[0])
-      y1 = min(img.height, y0 + frame[1])
-      box = (x0, y0, x1, y1)
-      absxy = (x0,y0)
-      if origin is None:
-        relxy = (0,0)
-      else:
-        relxy = (-origin[0], -origin[1])
+    if mode == "trim":
+      cboxes = _trim_boxes(rgba8888_bytes(img)[3::4], img.width, boxes, frame)
+      for box, cbox in zip(boxes, cboxes):
+        if cbox[2]-cbox[0] == box[2]-box[0] and cbox[3]-cbox[1] == box[3]-box[1]:
+          trimwarning += 1
+      slices = [(box[0]+cbox[0], box[1]+cbox[1], box[0]+cbox[2], box[1]+cbox[3]) for box, cbox in zip(boxes, cboxes)]
+    else:
+      slices = boxes
+    sheet = PreparedBitmap.pack(img, bformat) if packed is None else packed
+    bpp = 4 if bformat == "RGBA8888" else 1
+    if sheet is None:
+      datas = [None] * len(slices)
+    elif workers is not None and workers > 1 and len(slices) > workers:
+      from concurrent.futures import ThreadPoolExecutor
+      chunksize = -(-len(slices) // workers)
+      chunks = [slices[idx:idx+chunksize] for idx in range(0, len(slices), chunksize)]
+      datas = []
+      with ThreadPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(lambda chunk: _slice_tiles(sheet, img.width * bpp, bpp, chunk), chunks):
+          datas += result
+    else:
+      datas = _slice_tiles(sheet, img.width * bpp, bpp, slices)
+    if origin is None:
+      relxy = (0,0)
+    else:
+      relxy = (-origin[0], -origin[1])
+    for count, box in enumerate(boxes):
+      absxy = (box[0],box[1])
       attach = []
       for k in attach_shared.keys():
         attach.append((k,attach_shared[k]))
@@ -2968,36 +4381,159 @@ class PreparedBitmap(object):
         for k in aframe.keys():
           v = aframe[k]
           attach.append((k,v[0]-absxy[0]+relxy[0],v[1]-absxy[1]+relxy[1]))
+      tx0, ty0, tx1, ty1 = slices[count]
+      packed = (tx1 - tx0, ty1 - ty0, datas[count])
       if mode == "tile":
-        ans.append(PreparedBitmap(img.crop(box), bformat, 
+        ans.append(PreparedBitmap(None, bformat, 
           absxy[0]+relxy[0],absxy[1]+relxy[1], 
-          start_bufferid+count, attach))
+          start_bufferid+count, attach, packed=packed))
       elif mode == "trim":
-        tile = img.crop(box)
-        cbox = tile.getbbox()
-        print(tile,cbox)
-        absw, absh = (cbox[2]-cbox[0], cbox[3]-cbox[1])
-        if absw == tile.width and absh == tile.height:
-          trimwarning += 1
-        ans.append(PreparedBitmap(tile.crop(cbox), bformat,
+        cbox = cboxes[count]
+        ans.append(PreparedBitmap(None, bformat,
           cbox[0]+relxy[0],cbox[1]+relxy[1], 
-          start_bufferid+count, attach))
-      x0 = x0 + frame[0]
-      if x0 >= img.width:
-        x0 = 0
-        y0 = y0 + frame[1]
-      count += 1
+          start_bufferid+count, attach, packed=packed))
+    count = len(boxes)
+    if dedupe:
+      PreparedBitmap.dedupe(ans)
     if trimwarning > count // 2:
       errlog.append(f'WARNING: {trimwarning}/{count} images in this trimmed sheet are square. The source image may have an incorrect alpha channel.')
     return ans, errlog
 
+_index_tables = {bits:[bytes((n << (8 - bits * (k + 1))) & 0xFF for n in range(256)) for k in range(8 // bits)]
+  for bits in (1, 2, 4)}
+
+def _pack_indices(indices, width, bits):
+  """Pack one index per byte into bits per pixel, most significant bits first, padding each row of width pixels to
+  a whole byte."""
+  per = 8 // bits
+  pad = -width % per
+  rows = len(indices) // width
+  try:
+    import numpy as np
+  except ImportError:
+    if pad:
+      view = memoryview(indices)
+      indices = b''.join([bytes(view[y * width:(y + 1) * width]) + bytes(pad) for y in range(rows)])
+    acc = 0
+    for k in range(per):
+      acc |= int.from_bytes(indices[k::per].translate(_index_tables[bits][k]), "big")
+    return acc.to_bytes(len(indices) // per, "big")
+  px = np.zeros((rows, width + pad), dtype=np.uint8)
+  px[:, :width] = np.frombuffer(indices, dtype=np.uint8).reshape(rows, width)
+  px = px.reshape(rows, -1, per)
+  packed = np.zeros(px.shape[:2], dtype=np.uint8)
+  for k in range(per):
+    packed |= px[:, :, k] << (8 - bits * (k + 1))
+  return packed.tobytes()
+
+def _slice_tiles(sheet, stride, bpp, boxes):
+  """Cut each (x0, y0, x1, y1) box out of a packed sheet with rows of stride bytes, returning the packed bytes of each."""
+  try:
+    import numpy as np
+  except ImportError:
+    view = memoryview(sheet)
+    return [b''.join([view[y * stride + x0 * bpp:y * stride + x1 * bpp] for y in range(y0, y1)])
+      for x0, y0, x1, y1 in boxes]
+  rows = np.frombuffer(sheet, dtype=np.uint8).reshape(-1, stride)
+  return [rows[y0:y1, x0 * bpp:x1 * bpp].tobytes() for x0, y0, x1, y1 in boxes]
+
+def _trim_boxes(alpha, width, boxes, frame):
+  """Return the bounding box of the non-transparent pixels in each tile, relative to the tile, given the sheet's alpha
+  channel as bytes. boxes are the tiles of splitImage: full rows of frame[1] pixels, row by row, the last column
+  possibly narrower. An empty tile gets (0, 0, 1, 1)."""
+  if not boxes:
+    return []
+  try:
+    import numpy as np
+  except ImportError:
+    ans = []
+    for x0, y0, x1, y1 in boxes:
+      left = x1 - x0
+      right = 0
+      top = None
+      for y in range(y0, y1):
+        row = alpha[y * width + x0:y * width + x1]
+        used = len(row.rstrip(b'\0'))
+        if used:
+          if top is None:
+            top = y - y0
+          bottom = y - y0 + 1
+          left = min(left, len(row) - len(row.lstrip(b'\0')))
+          right = max(right, used)
+      ans.append((0, 0, 1, 1) if top is None else (left, top, right, bottom))
+    return ans
+  fw, fh = frame
+  cols = -(-width // fw)
+  rows = len(boxes) // cols
+  grid = np.zeros((rows * fh, cols * fw), dtype=bool)
+  grid[:, :width] = np.frombuffer(alpha, dtype=np.uint8).reshape(-1, width)[:rows * fh] != 0
+  grid = grid.reshape(rows, fh, cols, fw)
+  rowused = grid.any(axis=3)
+  colused = grid.any(axis=1)
+  top = rowused.argmax(axis=1)
+  bottom = fh - rowused[:, ::-1, :].argmax(axis=1)
+  left = colused.argmax(axis=2)
+  right = fw - colused[:, :, ::-1].argmax(axis=2)
+  empty = ~rowused.any(axis=1)
+  ans = []
+  for r in range(rows):
+    for c in range(cols):
+      if empty[r, c]:
+        ans.append((0, 0, 1, 1))
+      else:
+        ans.append((int(left[r, c]), int(top[r, c]), int(right[r, c]), int(bottom[r, c])))
+  return ans
+
+def rgba8888_bytes(img):
+  """Return a PIL/Pillow image as packed RGBA8888 bytes (R, G, B, A per pixel, rows top to bottom)."""
+  if img.mode != "RGBA":
+    img = img.convert("RGBA")
+  return img.tobytes()
+
+_rgba2222_tables = [bytes((n >> 6) << shift for n in range(256)) for shift in (0, 2, 4, 6)]
+
+def _pack_rgba2222(raw, tables):
+  """Pure-Python RGBA2222 packing: each channel is reduced to two bits and moved into place with one
+  bytes.translate table per channel, then the four channel strings are ORed together as big integers (the bits
+  don't overlap)."""
+  count = len(raw) // 4
+  acc = 0
+  for ch in range(4):
+    acc |= int.from_bytes(raw[ch::4].translate(tables[ch]), "little")
+  return acc.to_bytes(count, "little")
+
+def _rgba2222_numpy(np, raw):
+  px = np.frombuffer(raw, dtype="<u4")
+  packed = ((px >> 6) & 0x03) | ((px >> 12) & 0x0C) | ((px >> 18) & 0x30) | ((px >> 24) & 0xC0)
+  return packed.astype(np.uint8).tobytes()
+
+"""downcolor reduces each channel to one of the four levels the Agon displays, p // 85 * 85 (0, 85, 170, 255).
+RGBA2222 packing then keeps the level index p // 85 of each channel, so quantize_rgba2222 does both at once
+through a 256-entry table per channel."""
+
+_downcolor_table = bytes(n // 85 * 85 for n in range(256))
+_quantize_tables = [bytes((n // 85) << shift for n in range(256)) for shift in (0, 2, 4, 6)]
+
+def quantize_rgba2222(img):
+  """Downcolor a PIL/Pillow image and pack it as RGBA2222 bytes in a single pass; the same bytes as
+  rgba8888_to_rgba2222(PreparedBitmap.downcolor(img))."""
+  raw = rgba8888_bytes(img)
+  try:
+    import numpy as np
+  except ImportError:
+    return _pack_rgba2222(raw, _quantize_tables)
+  lut = np.frombuffer(_quantize_tables[0], dtype=np.uint8)
+  q = lut[np.frombuffer(raw, dtype=np.uint8).reshape(-1, 4)]
+  return (q[:, 0] | (q[:, 1] << 2) | (q[:, 2] << 4) | (q[:, 3] << 6)).tobytes()
+
 def rgba8888_to_rgba2222(img):
-  """Reduce a PIL/Pillow RGBA8888 image to a list of packed RGBA2222 bytes."""
-  ans = [] 
-  for r,g,b,a in (img.getdata()):
-    packed = ((a >> 6) << 6) + ((b >> 6) << 4) + ((g >> 6) << 2) + (r >> 6)
-    ans.append(packed)
-  return ans
+  """Reduce a PIL/Pillow image to packed RGBA2222 bytes, one byte per pixel. Uses NumPy when it is installed."""
+  raw = rgba8888_bytes(img)
+  try:
+    import numpy as np
+  except ImportError:
+    return _pack_rgba2222(raw, _rgba2222_tables)
+  return _rgba2222_numpy(np, raw)
 
 """The cmd_ functions are preset functions for generating common sequences of commands."""
 
@@ -3006,11 +4542,16 @@ def cmd_upload_blocks(bytebuffer, bufferid, blocksize=65535, then_consolidate=Tr
   splitting the blocks at the indicated size."""
   if blocksize > 65535 or blocksize < 1:
     raise Exception(f'Block size {blocksize} is out of range, expected between 1 and 65535')
+  # blocks of bytes-like buffers are returned as bytes, so the commands own their data (they can be pickled or
+  # copied, and later changes to the caller's buffer don't reach them); bytes slices go straight through
+  copy = isinstance(bytebuffer, (bytearray, memoryview))
+  if copy:
+    bytebuffer = memoryview(bytebuffer)
   idx = 0
   ans = []
   ans.append({"command":"buf_clear","bufferid":bufferid,"render":"bytes"})
   while idx < len(bytebuffer):
-    byteslice = bytebuffer[idx:idx+blocksize]
+    byteslice = bytes(bytebuffer[idx:idx+blocksize]) if copy else bytebuffer[idx:idx+blocksize]
     ans.append({"command":"buf_write_block","bufferid":bufferid,"buffer":byteslice,"render":"bytes"})
     idx += blocksize
   if len(ans)>1 and then_consolidate:
@@ -3043,17 +4584,131 @@ def cmd_testsample(channel, bufferid, base_rate, playback_rate):
   ans.append({"command":"aud_playnote","channel":channel,"volume":127,"frequency":playback_rate,"duration":5000,"render":"bytes"})
   return ans
 
-def cmd_upload_preparedbitmaps(pbitmaps):
+def cmd_upload_preparedbitmaps(pbitmaps, indexed_bufferid=None):
   """Automatically upload the indicated PreparedBitmaps, and prepare them as bitmaps.
+  Bitmaps that are an alias of another (see PreparedBitmap.dedupe) are skipped; they share its buffer.
+  With indexed_bufferid, RGBA2222 bitmaps of at most 16 colours are sent at 1, 2 or 4 bits per pixel (see
+  PreparedBitmap.indexed) whenever that is smaller, written to indexed_bufferid and expanded into their own buffers
+  on the device by buf_expandbitmap. A palette shared by enough bitmaps to pay for it is uploaded once, to
+  indexed_bufferid+1 upwards, and given to buf_expandbitmap as a buffermap. These buffers are cleared at the end.
     """
   ans = []
+  plans = _indexed_plans(pbitmaps) if indexed_bufferid is not None else {}
+  palettes = {}
+  for ix in plans.values():
+    key = (ix["bits"], tuple(ix["map"]))
+    palettes[key] = palettes.get(key, 0) + 1
+  buffermaps = {}
+  for (bits, colours), count in palettes.items():
+    if len(colours) * count > 14 + len(colours) + 2 * count: # upload of the map vs inline maps
+      buffermaps[(bits, colours)] = indexed_bufferid + 1 + len(buffermaps)
+      ans += cmd_upload_blocks(bytes(colours), buffermaps[(bits, colours)])
   for n in pbitmaps:
-    if n.bformat == "RGBA2222":
-      ans += cmd_upload_blocks(rgba8888_to_rgba2222(n.img), n.bufferid, n.blocksize)
+    if n.alias is not None:
+      continue
+    if id(n) in plans:
+      ix = plans[id(n)]
+      ans += cmd_upload_blocks(ix["data"], indexed_bufferid, n.blocksize)
+      expand = {"command":"buf_expandbitmap","targetid":n.bufferid,"sourceid":indexed_bufferid,"bits":ix["bits"],
+        "render":"bytes"}
+      if ix["width"] is not None:
+        expand["width"] = ix["width"]
+      key = (ix["bits"], tuple(ix["map"]))
+      if key in buffermaps:
+        expand["buffermap"] = buffermaps[key]
+      else:
+        expand["map"] = ix["map"]
+      ans.append(expand)
+    elif n.data is not None:
+      ans += cmd_upload_blocks(n.data, n.bufferid, n.blocksize)
     else:
       raise Exception('unsupported bitmap format: '+str(n.bformat))
     ans.append({"command":"bmp_select16","n":n.bufferid,"render":"bytes"})
     ans.append({"command":"bmp_makefrombuffer","w":n.w,"h":n.h,"format":n.bformat,"render":"bytes"})
+  if plans:
+    for bufferid in [indexed_bufferid] + list(buffermaps.values()):
+      ans.append({"command":"buf_clear","bufferid":bufferid,"render":"bytes"})
+  return ans
+
+def _indexed_plans(pbitmaps):
+  """The bitmaps that upload smaller through buf_expandbitmap, by id(), with their PreparedBitmap.indexed() form."""
+  plans = {}
+  for n in pbitmaps:
+    if n.alias is not None:
+      continue
+    ix = n.indexed()
+    if ix is None:
+      continue
+    # both ways need a buf_clear and buf_write_block; expanding adds its command, the width and the map
+    expand = 8 + (2 if ix["width"] is not None else 0) + len(ix["map"])
+    if len(ix["data"]) + expand < len(n.data):
+      plans[id(n)] = ix
+  return plans
+
+def atlas_bins(pbitmaps, maxsize=65535):
+  """Bin-pack PreparedBitmaps for cmd_upload_spriteatlas(): bitmaps whose packed data is the same length are packed
+  together, in order, into as few bins of at most maxsize bytes as possible. The bitmaps left over, whatever their
+  length, go into one mixed bin. Returns (bins, singles): bins is a list of (blocksize, [bitmaps]), with a blocksize
+  of None for the mixed bin; singles are the bitmaps that gain nothing from an atlas (larger than maxsize, or too
+  few left over to pay for the mixed bin). Aliases (see PreparedBitmap.dedupe) are left out.
+  A bin of one length costs a 2-byte target id per bitmap plus 24 bytes for the bin, the mixed bin 10 bytes per
+  bitmap plus 14, and uploading a bitmap by itself 14, so same-length bins take 4 or more bitmaps and the mixed bin
+  4 or more."""
+  sizes = {}
+  for n in pbitmaps:
+    if n.alias is not None:
+      continue
+    if n.data is None:
+      raise Exception('unsupported bitmap format: '+str(n.bformat))
+    sizes.setdefault(len(n.data), []).append(n)
+  bins = []
+  mixed = []
+  singles = []
+  for blocksize, members in sizes.items():
+    per = maxsize // blocksize if blocksize > 0 else 0
+    if per < 1:
+      singles += members
+      continue
+    for idx in range(0, len(members), per):
+      chunk = members[idx:idx+per]
+      if len(chunk) < 4:
+        mixed += chunk
+      else:
+        bins.append((blocksize, chunk))
+  if len(mixed) < 4:
+    singles += mixed
+  else:
+    bins.append((None, mixed))
+  return bins, singles
+
+def cmd_upload_spriteatlas(pbitmaps, atlas_bufferid, maxsize=65535):
+  """Upload PreparedBitmaps through atlas buffers, and prepare them as bitmaps, as cmd_upload_preparedbitmaps() does.
+  Bitmaps with data of the same length (as trimmed sprites from splitImage often are) are written as one block to
+  atlas_bufferid, then carved into their own buffers on the device by buf_splitspread, so a bin of N sprites costs
+  one buffer header and a 2-byte target id per sprite instead of N uploads. The rest are written to atlas_bufferid
+  one block per bitmap and handed out to their buffers by buf_spread, which saves each of them a buf_clear.
+  atlas_bufferid is reused for every bin and cleared at the end. The bitmaps' bufferids, x/y and attach points are
+  unchanged."""
+  bins, singles = atlas_bins(pbitmaps, maxsize)
+  ans = []
+  for blocksize, members in bins:
+    if blocksize is None:
+      ans += cmd_upload_blocks2([n.data for n in members], atlas_bufferid)
+      ans.append({"command":"buf_spread","bufferid":atlas_bufferid,"targetbuffer":[n.bufferid for n in members],
+        "render":"bytes"})
+      continue
+    ans += cmd_upload_blocks(b''.join([n.data for n in members]), atlas_bufferid)
+    ans.append({"command":"buf_splitspread","bufferid":atlas_bufferid,"blocksize":blocksize,
+      "targetbuffer":[n.bufferid for n in members],"render":"bytes"})
+  for n in singles:
+    ans += cmd_upload_blocks(n.data, n.bufferid, n.blocksize)
+  if bins:
+    ans.append({"command":"buf_clear","bufferid":atlas_bufferid,"render":"bytes"})
+  for n in pbitmaps:
+    if n.alias is not None:
+      continue
+    ans.append({"command":"bmp_select16","n":n.bufferid,"render":"bytes"})
+    ans.append({"command":"bmp_makefrombuffer","w":n.w,"h":n.h,"format":n.bformat,"render":"bytes"})
   return ans
 
 
@@ -3069,7 +4724,7 @@ def cmd_display_bitmaps(pbitmaps):
   using cmd_upload_preparedbitmaps()."""
   ans = []
   for n in pbitmaps:
-    ans.append({"command":"bmp_select16","n":n.bufferid,"render":"bytes"})
+    ans.append({"command":"bmp_select16","n":n.bitmapid(),"render":"bytes"})
     ans.append({"command":"bmp_draw","x":n.x,"y":n.y,"render":"bytes"})
   ans.append({"command":"mode_swap","render":"bytes"})
   return ans
@@ -3077,7 +4732,8 @@ def cmd_display_bitmaps(pbitmaps):
 def cmd_bitmaps_to_tiled_font(pbitmaps, fontbuffer, contextid):
   """Assigns a set of (previously uploaded) PreparedBitmaps to the indicated font buffer and context id. 
   It assigns all 256 characters, looping if there aren't
-  enough tiles available. The first bitmap's size is used to determine the font size."""
+  enough tiles available. The first bitmap's size is used to determine the font size.
+  Characters whose bitmap is an alias of another (see PreparedBitmap.dedupe) are pointed at that one's buffer."""
   commands = []
   commands.append({"command":"font_copysystem","bufferid":fontbuffer,"render":"bytes"})
   commands.append({"command":"font_property","bufferid":fontbuffer,"field":"width","value":pbitmaps[0].w,"render":"bytes"})
@@ -3086,16 +4742,69 @@ def cmd_bitmaps_to_tiled_font(pbitmaps, fontbuffer, contextid):
   commands.append({"command":"ctx_select","contextid":contextid,"render":"bytes"})
   for n in range(256):
     tb = pbitmaps[n % len(pbitmaps)]
-    commands.append({"command":"sys_charbitmap","char":n,"bitmapid":tb.bufferid,"render":"bytes"})  
+    commands.append({"command":"sys_charbitmap","char":n,"bitmapid":tb.bitmapid(),"render":"bytes"})  
   return commands
 
-def cmd_upload_font_tileset(ipath, bitmap_start_bufferid, font_bufferid, contextid, frame, iformat="RGBA2222"):
-  """Open an image and generate the commands needed to upload the tiles as a font."""
+def tilegrid_fits(width, frame, bformat):
+  """Whether a sheet width pixels wide can be sliced on the device by cmd_upload_tilegrid(): the tiles must fill
+  the width exactly and each row of tiles must fit in one 64 KB block."""
+  bpp = 4 if bformat == "RGBA8888" else 1
+  return width % frame[0] == 0 and frame[1] * width * bpp <= 65535
+
+def cmd_upload_tilegrid(img, bformat, start_bufferid, frame, sheet_bufferid, blocksize=65535, packed=None):
+  """Upload a sheet of equal tiles as one consolidated buffer and have the VDP slice it into bitmaps itself.
+  The tiles get ascending bufferids from start_bufferid, row by row, like splitImage(mode="tile"); rows of the sheet
+  below the last full row of tiles are left out. The sheet goes to sheet_bufferid, and is cut into rows of tiles in
+  sheet_bufferid+1 upwards with buf_splitspreadid; each row is then split into its tiles with buf_splitspreadwidthid.
+  These working buffers are cleared at the end, and must not overlap the tiles' bufferids. The sheet must pass
+  tilegrid_fits(). packed is the sheet already run through PreparedBitmap.pack(img, bformat), if the caller has it."""
+  if not tilegrid_fits(img.width, frame, bformat):
+    raise Exception(f'A {img.width} pixel wide sheet can\'t be sliced into {frame[0]}x{frame[1]} tiles on the device')
+  bpp = 4 if bformat == "RGBA8888" else 1
+  cols = img.width // frame[0]
+  rows = img.height // frame[1]
+  if sheet_bufferid <= start_bufferid + rows * cols - 1 and start_bufferid <= sheet_bufferid + rows:
+    raise Exception(f'Working buffers {sheet_bufferid}-{sheet_bufferid + rows} overlap the tiles\' buffers ' +
+      f'{start_bufferid}-{start_bufferid + rows * cols - 1}')
+  sheet = PreparedBitmap.pack(img, bformat) if packed is None else packed
+  if sheet is None:
+    raise Exception('unsupported bitmap format: '+str(bformat))
+  stripsize = frame[1] * img.width * bpp
+  ans = cmd_upload_blocks(sheet[:rows * stripsize], sheet_bufferid, blocksize)
+  ans.append({"command":"buf_splitspreadid","bufferid":sheet_bufferid,"blocksize":stripsize,
+    "targetid":sheet_bufferid+1,"render":"bytes"})
+  for r in range(rows):
+    ans.append({"command":"buf_splitspreadwidthid","bufferid":sheet_bufferid+1+r,"width":frame[0] * bpp,
+      "blockcount":cols,"targetid":start_bufferid+r*cols,"render":"bytes"})
+  for n in range(rows + 1):
+    ans.append({"command":"buf_clear","bufferid":sheet_bufferid+n,"render":"bytes"})
+  for n in range(rows * cols):
+    ans.append({"command":"bmp_select16","n":start_bufferid+n,"render":"bytes"})
+    ans.append({"command":"bmp_makefrombuffer","w":frame[0],"h":frame[1],"format":bformat,"render":"bytes"})
+  return ans
+
+def cmd_upload_font_tileset(ipath, bitmap_start_bufferid, font_bufferid, contextid, frame, iformat="RGBA2222",
+  dedupe=False, sheet_bufferid=None, indexed_bufferid=None):
+  """Open an image and generate the commands needed to upload the tiles as a font.
+  With dedupe, repeated tiles are uploaded once and their characters share the buffer; the tiles keep their
+  bufferids (bitmap_start_bufferid upwards), but the buffers of repeats are never created, so select tiles by
+  their bitmapid() rather than their bufferid.
+  With sheet_bufferid, the sheet is instead uploaded whole and sliced on the device (see cmd_upload_tilegrid()), using
+  sheet_bufferid upwards as working buffers; if the sheet doesn't fit a grid, the tiles are uploaded one by one and
+  a note is added to the log.
+  indexed_bufferid is passed on to cmd_upload_preparedbitmaps() when the tiles are uploaded one by one."""
   from PIL import Image
   ifile = Image.open(ipath)
+  sheet = PreparedBitmap.pack(ifile, iformat)
   tilebmps, errlog = PreparedBitmap.splitImage(ifile, iformat, bitmap_start_bufferid, frame, mode="tile", 
-  origin=None)
-  commands = cmd_upload_preparedbitmaps(tilebmps) + cmd_bitmaps_to_tiled_font(tilebmps, font_bufferid, contextid)
+  origin=None, dedupe=dedupe, packed=sheet)
+  if sheet_bufferid is not None and tilegrid_fits(ifile.width, frame, iformat):
+    upload = cmd_upload_tilegrid(ifile, iformat, bitmap_start_bufferid, frame, sheet_bufferid, packed=sheet)
+  else:
+    if sheet_bufferid is not None:
+      errlog.append(f'NOTE: {ipath} can\'t be sliced into {frame[0]}x{frame[1]} tiles on the device; uploading tiles one by one.')
+    upload = cmd_upload_preparedbitmaps(tilebmps, indexed_bufferid)
+  commands = upload + cmd_bitmaps_to_tiled_font(tilebmps, font_bufferid, contextid)
   return {"pbmps":tilebmps, "src":ifile, "log":errlog, "commands":commands}
 
 def cmd_hello_world(text="Hello world"):
@@ -3109,6 +4818,7 @@ class VDPBufferAllocator(object):
     self.tab = {}
     self.cells = {}
     self.stores = {}
+    self.aliases = {}
   def define(self, allocid, start, length=1):
     for n in range(start, start+length):
       if n in self.cells:
@@ -3126,19 +4836,62 @@ class VDPBufferAllocator(object):
       for n in self.tab[allocid]:
         if not (n in self.stores):
           self.stores[n] = (searchid, value)
-          return
+          return n
       raise Exception("Storage to \""+str(allocid)+"\" will not fit - clear() it first")
+  def alias(self, searchid, target):
+    """Make searchid find the buffer stored under target, without using a buffer of its own."""
+    n = target
+    while n in self.aliases:
+      if n == searchid:
+        break
+      n = self.aliases[n]
+    if n == searchid:
+      raise ValueError("Alias of \""+str(searchid)+"\" to \""+str(target)+"\" would make a cycle")
+    self.aliases[searchid] = target
+  def store_bitmaps(self, allocid, pbitmaps, searchids=None):
+    """Store PreparedBitmaps in allocid, one buffer per distinct bitmap, and set each bitmap's bufferid to the buffer
+    it was given. A bitmap that is an alias of another (see PreparedBitmap.dedupe) takes no buffer; its searchid is
+    made an alias of the other's. searchids default to the bitmaps' bufferids before allocation.
+    Returns the remap table: for each bitmap in order, the bufferid holding its pixels."""
+    if searchids is None:
+      searchids = [n.bufferid for n in pbitmaps]
+    names = {}
+    for n, searchid in zip(pbitmaps, searchids):
+      if n.alias is None:
+        n.bufferid = self.store(allocid, searchid, n)
+        names[id(n)] = searchid
+    for n, searchid in zip(pbitmaps, searchids):
+      if n.alias is not None:
+        if not id(n.alias) in names:
+          raise Exception("Bitmap \""+str(searchid)+"\" is an alias of a bitmap that isn't being stored")
+        self.alias(searchid, names[id(n.alias)])
+    return [n.bitmapid() for n in pbitmaps]
   def clear(self, allocid):
+    """Free the buffers of allocid, along with any aliases that lead to what was stored in them."""
+    cleared = set()
     for n in self.tab[allocid]:
-      del self.stores[n]
+      if n in self.stores:
+        cleared.add(self.stores.pop(n)[0])
+    while cleared:
+      cleared = set([k for k, v in self.aliases.items() if v in cleared])
+      for k in cleared:
+        del self.aliases[k]
   def search(self, searchid):
+    if searchid in self.aliases:
+      target = self.aliases[searchid]
+      while target in self.aliases: # alias() refuses cycles
+        target = self.aliases[target]
+      ans = self.search(target)
+      if ans is not None:
+        ans["searchid"] = searchid
+      return ans
     for k in self.stores:
       v = self.stores[k]
       if v[0] == searchid:
         return {"allocid":self.cells[k],"bufferid":k,"searchid":v[0],"value":v[1]}
     return None
   def __repr__(self):
-    return f'<VDPBufferAllocator {len(self.tab)} definitions, {len(self.stores)} stored buffers>'
+    return f'<VDPBufferAllocator {len(self.tab)} definitions, {len(self.stores)} stored buffers, {len(self.aliases)} aliases>'
 
 def init_path(path):
   import os
@@ -3147,15 +4900,686 @@ def init_path(path):
   except:
     pass
 
-def writevdu(path, commands):
+def writevdu(path, commands, buffersize=65536, cache=None, preallocate=False, stats=None):
+  """Encode commands (any iterable of configs, including a generator) and write the bytes to path.
+  Each command is written as soon as it is encoded, through a write buffer of buffersize bytes, so memory
+  use stays flat regardless of the size of the output. cache is an optional EncodeCache.
+  preallocate=True instead encodes every command first, adds up the exact output size from the size lists,
+  packs all commands into one bytearray with pack_into and writes it with a single call; preallocate="mmap"
+  packs straight into a memory map of the output file. Either way no per-command bytes objects are made for
+  commands rendered with "bytes" or "fast", at the cost of holding every command's data lists until the end.
+  stats is an optional ProcessStats."""
+  if preallocate:
+    return _writevdu_preallocated(path, commands, cache, preallocate == "mmap", stats)
   errlog = []
-  fw = open(path,'wb')
+  fw = open(path, 'wb', buffering=buffersize)
   count = 0
-  for n in process(commands):
-    if len(n["log"])>0:
-      errlog.append("command "+str(count+1))
-      errlog.append(print(n))
-    count += fw.write(n["bytes"])
-  fw.close()
+  try:
+    for idx, n in enumerate(iprocess(commands, cache, stats)):
+      if len(n["log"])>0:
+        errlog.append("command "+str(idx+1))
+        errlog += n["log"]
+      count += fw.write(n["bytes"])
+  finally:
+    fw.close()
   return {"path":path,"log":errlog,"size":count}
 
+def _plan_one(n, cache):
+  """First pass of a preallocated writevdu: returns (size, kind, value, log) where kind says how the second pass
+  writes value: "struct" for a (struct, args[, data, sizes]) tuple, "ans" for an encoder result with payload
+  segments, and "bytes" for everything else."""
+  if cache is None and type(n) is dict:
+    render = n.get("render")
+    if render == "fast" and not "doc" in n:
+      layout = _fast_compiled.get(n["command"]) or _fast_layout(n["command"])
+      if layout is not None:
+        args = _fast_args(layout, n)
+        if args is not None:
+          return (layout[0].size, "struct", (layout[0], args), None)
+    if render == "bytes" or render == "fast":
+      na = optable[n["command"]](n)
+      data = na["data"]
+      if len(data)!=len(na["size"]):
+        na["log"].append(f'Mismatched length of data({len(data)}) vs size({len(na["size"])}). Will not render bytes.')
+        return (0, "bytes", b'', na["log"])
+      sizes = tuple(na["size"])
+      packer = _size_packer(sizes)
+      if packer:
+        args = _fixup_args(packer, data) if packer[1] else data
+        if args is not None: # keep just the lists needed to pack, not the whole encoder result
+          return (packer[0].size, "struct", (packer[0], args, data, sizes), na["log"] or None)
+      return (sum(na["size"]), "ans", na, na["log"])
+  na = _process_one(n, cache)
+  return (len(na["bytes"]), "bytes", na["bytes"], na["log"])
+
+def _writevdu_preallocated(path, commands, cache, use_mmap, stats=None):
+  errlog = []
+  plans = []
+  total = 0
+  if stats is not None:
+    from time import perf_counter
+  for idx, n in enumerate(commands):
+    if stats is None:
+      plan = _plan_one(n, cache)
+    else:
+      t0 = perf_counter()
+      plan = _plan_one(n, cache)
+      seconds = perf_counter() - t0
+      if isinstance(n, CommandBatch):
+        stats.record(n.command, seconds, plan[0], 1 if plan[3] else 0, 0, n.count)
+      else:
+        # a fast layout's plan is a bare (struct, args) pair; anything else went through the encoder
+        fast = plan[1] == "struct" and len(plan[2]) == 2
+        stats.record(n["command"], seconds, plan[0], 1 if plan[3] else 0,
+          1 if n.get("render") == "fast" and not fast else 0)
+    if plan[3]:
+      errlog.append("command "+str(idx+1))
+      errlog += plan[3]
+    plans.append(plan)
+    total += plan[0]
+  fw = open(path, 'w+b' if use_mmap else 'wb')
+  try:
+    if use_mmap and total > 0:
+      import mmap
+      fw.truncate(total)
+      buf = mmap.mmap(fw.fileno(), total)
+    else:
+      buf = bytearray(total)
+    offset = 0
+    for size, kind, value, log in plans:
+      if kind == "struct":
+        try:
+          value[0].pack_into(buf, offset, *value[1])
+        except struct.error: # negative values, payload segments or values too large for their size
+          _render_into({"data":value[2], "size":value[3]}, buf, offset)
+      elif kind == "ans":
+        _render_into(value, buf, offset)
+      else:
+        buf[offset:offset+size] = value
+      offset += size
+    if use_mmap and total > 0:
+      buf.flush()
+      buf.close()
+    else:
+      fw.write(buf)
+  finally:
+    fw.close()
+  return {"path":path,"log":errlog,"size":total}
+
+_digest_plain = {str, int, float, bool, type(None)}
+
+def _digest_stable(value):
+  """True if repr(value) is a stable and unambiguous encoding of value: plain scalars, and lists/tuples of them.
+  Payloads are left to _digest_update, which hashes them without the repr expansion."""
+  tv = type(value)
+  if tv in _digest_plain:
+    return True
+  if tv is list or tv is tuple:
+    if set(map(type, value)) <= _digest_plain:
+      return True
+    return all(_digest_stable(n) for n in value)
+  return False
+
+def _digest_plaindict(value):
+  return set(map(type, value)) <= {str} and (set(map(type, value.values())) <= _digest_plain or
+    all(_digest_stable(v) for v in value.values()))
+
+def _digest_repr(h, value):
+  """Hash value by its repr. A run of plain command dicts is hashed as one list of sorted item lists."""
+  text = repr(value).encode()
+  h.update(f'repr:{len(text)};'.encode())
+  h.update(text)
+
+def _digest_update(h, value):
+  """Feed a command list (or any value inside one) to a hashlib object in a stable, unambiguous form. Payloads
+  are hashed as raw bytes without being copied. Raises TypeError for values with no stable form."""
+  tv = type(value)
+  if tv is str or tv is int or tv is float or tv is bool or value is None:
+    h.update(f'{tv.__name__}:{value!r};'.encode())
+  elif tv is bytes or tv is bytearray or tv is memoryview:
+    mv = memoryview(value)
+    if mv.format != 'B' or mv.ndim != 1:
+      mv = mv.cast('B')
+    h.update(f'bytes:{len(mv)};'.encode())
+    h.update(mv)
+  elif tv is dict:
+    if _digest_plaindict(value):
+      _digest_repr(h, sorted(value.items()))
+      return
+    h.update(f'dict:{len(value)};'.encode())
+    for k in sorted(value):
+      _digest_update(h, k)
+      _digest_update(h, value[k])
+  elif tv is list or tv is tuple:
+    h.update(f'{tv.__name__}:{len(value)};'.encode())
+    run = []
+    for n in value:
+      if type(n) is dict and _digest_plaindict(n):
+        run.append(sorted(n.items()))
+      else:
+        if run:
+          _digest_repr(h, run)
+          run = []
+        _digest_update(h, n)
+    if run:
+      _digest_repr(h, run)
+  elif tv is CommandBatch:
+    h.update(b'batch;')
+    _digest_update(h, value.command)
+    _digest_update(h, value.config)
+    h.update(f'columns:{len(value.columns)};'.encode())
+    for k in sorted(value.columns):
+      _digest_update(h, k)
+      col = value.columns[k]
+      if type(col) is list or type(col) is tuple:
+        _digest_update(h, list(col))
+      elif hasattr(col, "tobytes"):
+        h.update(f'array:{getattr(col, "dtype", None) or col.typecode}:{len(col)};'.encode())
+        h.update(col.tobytes())
+      else:
+        raise TypeError(f'cannot hash column {k} of type {type(col).__name__}')
+  else:
+    raise TypeError(f'cannot hash value of type {tv.__name__}')
+
+_library_digest = None
+
+def _library_version():
+  """__version__ plus a digest of this module's source, so editing the encoders invalidates cached builds
+  even without a version bump."""
+  global _library_digest
+  if _library_digest is None:
+    import hashlib
+    try:
+      with open(__file__, "rb") as f:
+        _library_digest = hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+      _library_digest = ""
+  return __version__ + ":" + _library_digest
+
+class BuildCache(object):
+  def __init__(self, path, maxsize=256*1024*1024):
+    """Content-addressed on-disk cache of .vdu outputs. writevdu() through the cache hashes the command list with
+    the library version; when an artifact with that hash exists, it is copied to the output path (or left alone if
+    the output is already the copy made last time) instead of encoding the commands again.
+    Artifacts are stored as path/objects/<2 hex>/<hash>.vdu with a .json file holding the log, and the least
+    recently used ones are evicted once the total size passes maxsize bytes. hits and misses count writevdu() calls."""
+    import os
+    self.path = path
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+  def key(self, commands):
+    """Return the hex digest for a command list, or None if it contains values that can't be hashed stably."""
+    import hashlib
+    h = hashlib.sha256()
+    _digest_update(h, _library_version())
+    try:
+      _digest_update(h, commands)
+    except TypeError:
+      return None
+    return h.hexdigest()
+  def _object(self, key):
+    import os
+    return os.path.join(self.path, "objects", key[:2], key + ".vdu")
+  def _readmeta(self, key):
+    import json
+    try:
+      with open(self._object(key)[:-4] + ".json", "r") as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+  def _writemeta(self, key, meta):
+    import json
+    import os
+    fn = self._object(key)[:-4] + ".json"
+    with open(fn + ".tmp", "w") as f:
+      json.dump(meta, f)
+    os.replace(fn + ".tmp", fn)
+  def writevdu(self, path, commands, buffersize=65536, cache=None):
+    """Same as writevdu(path, commands), plus "cached": True when the output came from the cache. Generators
+    are consumed into a list so they can be hashed first."""
+    import os
+    import shutil
+    if not (type(commands) is list or type(commands) is tuple):
+      commands = list(commands)
+    key = self.key(commands)
+    if key is None:
+      self.misses += 1
+      ans = writevdu(path, commands, buffersize, cache)
+      ans["cached"] = False
+      return ans
+    obj = self._object(key)
+    meta = self._readmeta(key) if os.path.exists(obj) else None
+    dest = os.path.abspath(path)
+    if meta is not None:
+      self.hits += 1
+      os.utime(obj)
+      try:
+        st = os.stat(dest)
+        current = meta["outputs"].get(dest) == [st.st_size, st.st_mtime_ns]
+      except OSError:
+        current = False
+      if not current:
+        shutil.copyfile(obj, path)
+        st = os.stat(dest)
+        meta["outputs"][dest] = [st.st_size, st.st_mtime_ns]
+        self._writemeta(key, meta)
+      return {"path":path,"log":meta["log"],"size":meta["size"],"cached":True}
+    self.misses += 1
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    ans = writevdu(obj + ".tmp", commands, buffersize, cache)
+    os.replace(obj + ".tmp", obj)
+    shutil.copyfile(obj, path)
+    st = os.stat(dest)
+    self._writemeta(key, {"log":ans["log"],"size":ans["size"],"outputs":{dest:[st.st_size, st.st_mtime_ns]}})
+    self.evict()
+    return {"path":path,"log":ans["log"],"size":ans["size"],"cached":False}
+  def entries(self):
+    """List (last used, size, path) for every artifact, least recently used first."""
+    import os
+    ans = []
+    root = os.path.join(self.path, "objects")
+    for sub in os.listdir(root):
+      subpath = os.path.join(root, sub)
+      if not os.path.isdir(subpath):
+        continue
+      for fn in os.listdir(subpath):
+        if fn.endswith(".vdu"):
+          st = os.stat(os.path.join(subpath, fn))
+          ans.append((st.st_mtime_ns, st.st_size, os.path.join(subpath, fn)))
+    ans.sort()
+    return ans
+  def evict(self, maxsize=None):
+    """Remove the least recently used artifacts until the cache is no larger than maxsize (default self.maxsize).
+    Returns the number of bytes removed."""
+    import os
+    if maxsize is None:
+      maxsize = self.maxsize
+    entries = self.entries()
+    total = sum(n[1] for n in entries)
+    removed = 0
+    for mtime, size, fn in entries:
+      if total <= maxsize:
+        break
+      for victim in (fn, fn[:-4] + ".json"):
+        try:
+          os.remove(victim)
+        except OSError:
+          pass
+      total -= size
+      removed += size
+    return removed
+  def stats(self):
+    entries = self.entries()
+    return {"hits":self.hits, "misses":self.misses, "entries":len(entries), "size":sum(n[1] for n in entries),
+      "maxsize":self.maxsize}
+  def __repr__(self):
+    st = self.stats()
+    return f'<BuildCache {self.path}: {st["entries"]} entries, {st["size"]}/{st["maxsize"]} bytes, {st["hits"]} hits, {st["misses"]} misses>'
+
+def _file_digest(path):
+  import hashlib
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+def _generator_signature(fn):
+  """Identify a generator by name and code, so editing it makes its targets stale. The code hashed includes the
+  functions of the same module it calls by name (e.g. the demo a small build wrapper runs), their nested functions,
+  and _library_version(), so that editing the encoders does too. functools.partial objects are identified by the
+  wrapped function and their arguments."""
+  import hashlib
+  import types
+  h = hashlib.sha256()
+  h.update(_library_version().encode())
+  args = getattr(fn, "args", None)
+  if args is not None and hasattr(fn, "func"):
+    try:
+      _digest_update(h, [list(args), dict(fn.keywords)])
+    except TypeError:
+      h.update(repr((args, fn.keywords)).encode())
+    fn = fn.func
+  seen = set()
+  def visit(code, names):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    h.update(repr([n for n in code.co_consts if _digest_stable(n)]).encode())
+    for n in code.co_consts:
+      if isinstance(n, types.CodeType):
+        visit(n, names)
+    for name in code.co_names:
+      f = names.get(name)
+      if isinstance(f, types.FunctionType) and f.__module__ == fn.__module__ and not f in seen:
+        seen.add(f)
+        visit(f.__code__, f.__globals__)
+  code = getattr(fn, "__code__", None)
+  if code is not None:
+    seen.add(fn)
+    visit(code, getattr(fn, "__globals__", {}))
+  name = getattr(fn, "__module__", "") + "." + getattr(fn, "__qualname__", type(fn).__name__)
+  return name + ":" + h.hexdigest()[:16]
+
+def _build_run(generator, path, sources):
+  import time
+  t0 = time.perf_counter()
+  generator(path, sources)
+  return time.perf_counter() - t0
+
+class BuildGraph(object):
+  def __init__(self, targets=None, statefile="vdpbuild.json", workers=None, pool="process"):
+    """Change-driven build of asset targets (.vdu, .4th, ...). Each target is an output path with a list of
+    source files and a generator, called as generator(path, sources) to write the output. A target whose source
+    is another target's output depends on it and is built after it.
+    targets is an optional dict of {path: {"sources":[...], "generator":fn, "outputs":[...]}}, the same as calling
+    target() for each entry; "outputs" is optional and lists any other files the generator writes. The mtime, size and hash of every source are recorded in statefile after a build; a target is
+    rebuilt only if its output is missing, its generator changed, or a source changed content. Independent
+    targets run in a pool of workers: processes by default (generators must then be picklable, e.g. module-level
+    functions or functools.partial of them), or pool="thread"."""
+    self.targets = {}
+    self.owners = {}
+    self.statefile = statefile
+    self.workers = workers
+    self.pool = pool
+    if targets is not None:
+      for path in targets:
+        self.target(path, **targets[path])
+  def target(self, path, sources, generator, outputs=()):
+    """Add a target. outputs are the other files generator writes besides path; each file may have only one
+    owning target (raises ValueError otherwise), and a target is stale while any of its outputs is missing."""
+    path = str(path)
+    outputs = [str(n) for n in outputs]
+    for n in [path] + outputs:
+      if n in self.owners and self.owners[n] != path:
+        raise ValueError(f'{n} is written by both {self.owners[n]} and {path}')
+    self.targets[path] = {"sources":[str(n) for n in sources], "generator":generator, "outputs":outputs}
+    for n in [path] + outputs:
+      self.owners[n] = path
+  def _deps(self, path):
+    """The targets producing the sources of path."""
+    return [self.owners[n] for n in self.targets[path]["sources"] if n in self.owners and self.owners[n] != path]
+  def _loadstate(self):
+    import json
+    try:
+      with open(self.statefile, "r") as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+  def _savestate(self, state):
+    import json
+    import os
+    with open(self.statefile + ".tmp", "w") as f:
+      json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(self.statefile + ".tmp", self.statefile)
+  def order(self):
+    """Return the target paths in dependency order. Raises ValueError on a cycle."""
+    ans = []
+    state = {}
+    def visit(path, chain):
+      if state.get(path) == 2:
+        return
+      if state.get(path) == 1:
+        raise ValueError("dependency cycle: " + " -> ".join(chain + [path]))
+      state[path] = 1
+      for dep in self._deps(path):
+        visit(dep, chain + [path])
+      state[path] = 2
+      ans.append(path)
+    for path in self.targets:
+      visit(path, [])
+    return ans
+  def _sourcestate(self, path, recorded):
+    """Return [mtime_ns, size, sha256] for a source, reusing the recorded hash when mtime and size are unchanged."""
+    import os
+    st = os.stat(path)
+    if recorded is not None and recorded[0] == st.st_mtime_ns and recorded[1] == st.st_size:
+      return recorded
+    return [st.st_mtime_ns, st.st_size, _file_digest(path)]
+  def stale(self, path, state=None):
+    """Return the reason path needs rebuilding, or None if it is up to date."""
+    import os
+    if state is None:
+      state = self._loadstate()
+    t = self.targets[path]
+    rec = state.get(path)
+    for n in [path] + t["outputs"]:
+      if not os.path.exists(n):
+        return "missing output" if n == path else f'missing output {n}'
+    if rec is None:
+      return "not built before"
+    if rec.get("generator") != _generator_signature(t["generator"]):
+      return "generator changed"
+    if sorted(rec["sources"]) != sorted(t["sources"]):
+      return "sources changed"
+    for src in t["sources"]:
+      try:
+        cur = self._sourcestate(src, rec["sources"][src])
+      except OSError:
+        return f'missing source {src}'
+      if cur[2] != rec["sources"][src][2]:
+        return f'{src} changed'
+    return None
+  def _record(self, path, state):
+    t = self.targets[path]
+    prev = state.get(path, {}).get("sources", {})
+    state[path] = {"generator":_generator_signature(t["generator"]),
+      "sources":{src:self._sourcestate(src, prev.get(src)) for src in t["sources"]}}
+  def build(self, targets=None, force=False, verbose=True):
+    """Build the given target paths (default all) and everything they depend on, skipping targets that are up to
+    date unless force is set. Returns {path: {"status", "reason", "time", "error"}} with status one of "built",
+    "fresh", "failed" or "skipped" (a dependency failed), and prints summary() when verbose."""
+    import time
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+    order = self.order()
+    if targets is not None:
+      wanted = set()
+      def want(path):
+        if not path in wanted:
+          wanted.add(path)
+          for dep in self._deps(path):
+            want(dep)
+      for path in targets:
+        want(str(path))
+      order = [n for n in order if n in wanted]
+    state = self._loadstate()
+    results = {}
+    pending = list(order)
+    running = {}
+    t0 = time.perf_counter()
+    executor = (ThreadPoolExecutor if self.pool == "thread" else ProcessPoolExecutor)(max_workers=self.workers)
+    try:
+      while pending or running:
+        for path in list(pending):
+          deps = self._deps(path)
+          if any(not n in results for n in deps):
+            continue
+          pending.remove(path)
+          if any(results[n]["status"] in ("failed", "skipped") for n in deps):
+            results[path] = {"status":"skipped", "reason":"dependency failed", "time":0.0, "error":None}
+            continue
+          reason = "forced" if force else self.stale(path, state)
+          if reason is None:
+            results[path] = {"status":"fresh", "reason":None, "time":0.0, "error":None}
+            self._record(path, state)
+            continue
+          t = self.targets[path]
+          running[executor.submit(_build_run, t["generator"], path, t["sources"])] = (path, reason)
+        if not running:
+          continue
+        done, notdone = wait(running, return_when=FIRST_COMPLETED)
+        for fut in done:
+          path, reason = running.pop(fut)
+          try:
+            results[path] = {"status":"built", "reason":reason, "time":fut.result(), "error":None}
+            self._record(path, state)
+          except Exception as e:
+            results[path] = {"status":"failed", "reason":reason, "time":0.0, "error":repr(e)}
+            state.pop(path, None)
+    finally:
+      executor.shutdown()
+      self._savestate(state)
+    self.elapsed = time.perf_counter() - t0
+    if verbose:
+      print(self.summary(results))
+    return results
+  def summary(self, results):
+    """Format build() results as a table of target, status and time, slowest first."""
+    width = max([len(n) for n in results], default=6)
+    lines = [f'{"target":<{width}}  {"status":<7}  {"time":>8}  reason']
+    for path in sorted(results, key=lambda n: -results[n]["time"]):
+      r = results[path]
+      note = r["error"] or r["reason"] or ""
+      lines.append(f'{path:<{width}}  {r["status"]:<7}  {r["time"]:8.3f}  {note}')
+    built = [n for n in results.values() if n["status"] == "built"]
+    lines.append(f'{len(built)} built, {len(results)-len(built)} not rebuilt, ' +
+      f'{sum(n["time"] for n in built):.3f}s in generators, {getattr(self, "elapsed", 0.0):.3f}s elapsed')
+    return "\n".join(lines)
+
+class SerialTransport(object):
+  def __init__(self, port, baud=1152000, chunksize=1024, pace=0.0, rtscts=False, use_pyserial=True):
+    """Stream encoded commands to an Agon over a serial port instead of going through a .vdu file on SD.
+    port is a device path (e.g. "/dev/ttyUSB0"), an open file descriptor, or an already opened pyserial port.
+    Paths are opened with pyserial when it is installed (and use_pyserial is set), otherwise as a raw tty: 8N1,
+    no echo or line processing, at baud. Data goes out in chunks of chunksize bytes, each followed by pace
+    seconds of sleep so the receiver can drain its buffer (1024 bytes matches vdu-stream-curfile's buffer);
+    rtscts enables hardware flow control. stats() reports what has been sent and the throughput achieved."""
+    self.port = port
+    self.baud = baud
+    self.chunksize = chunksize
+    self.pace = pace
+    self.rtscts = rtscts
+    self.use_pyserial = use_pyserial
+    self.serial = None
+    self.fd = None
+    self.ownfd = False
+    self.savedattrs = None
+    self.sent = 0
+    self.chunks = 0
+    self.seconds = 0.0
+  def open(self):
+    if self.serial is not None or self.fd is not None:
+      return self
+    if type(self.port) is int:
+      self.fd = self.port
+      return self
+    if not (type(self.port) is str):
+      self.serial = self.port
+      return self
+    if self.use_pyserial:
+      try:
+        import serial
+      except ImportError:
+        serial = None
+      if serial is not None:
+        self.serial = serial.Serial(self.port, self.baud, rtscts=self.rtscts)
+        return self
+    import os
+    fd = os.open(self.port, os.O_WRONLY | os.O_NOCTTY)
+    try:
+      self._setraw(fd)
+    except Exception:
+      os.close(fd)
+      raise
+    self.fd = fd
+    self.ownfd = True
+    return self
+  def _setraw(self, fd):
+    import termios
+    speed = getattr(termios, f'B{self.baud}', None)
+    if speed is None:
+      raise ValueError(f'baud rate {self.baud} is not supported by termios on this platform')
+    self.savedattrs = termios.tcgetattr(fd)
+    iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd)
+    iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP | termios.INLCR | termios.IGNCR |
+      termios.ICRNL | termios.IXON | termios.IXOFF)
+    oflag &= ~termios.OPOST
+    lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+    cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB)
+    cflag |= termios.CS8 | termios.CLOCAL
+    crtscts = getattr(termios, "CRTSCTS", 0)
+    if self.rtscts:
+      cflag |= crtscts
+    else:
+      cflag &= ~crtscts
+    termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+  def close(self):
+    import os
+    if self.fd is not None and self.ownfd:
+      import termios
+      try:
+        termios.tcdrain(self.fd)
+        if self.savedattrs is not None:
+          termios.tcsetattr(self.fd, termios.TCSANOW, self.savedattrs)
+      finally:
+        os.close(self.fd)
+    elif self.serial is not None and type(self.port) is str:
+      self.serial.flush()
+      self.serial.close()
+    self.fd = None
+    self.serial = None
+    self.ownfd = False
+  def __enter__(self):
+    return self.open()
+  def __exit__(self, *exc):
+    self.close()
+  def _writeall(self, chunk):
+    import os
+    if self.serial is not None:
+      self.serial.write(chunk)
+      return
+    view = memoryview(chunk)
+    while len(view):
+      n = os.write(self.fd, view)
+      view = view[n:]
+  def write(self, data):
+    """Send bytes-like data in chunks, pacing between them. Returns the number of bytes sent."""
+    import time
+    self.open()
+    view = memoryview(data)
+    if view.format != 'B' or view.ndim != 1:
+      view = view.cast('B')
+    t0 = time.perf_counter()
+    for start in range(0, len(view), self.chunksize):
+      self._writeall(view[start:start+self.chunksize])
+      self.chunks += 1
+      if self.pace > 0:
+        time.sleep(self.pace)
+    self.seconds += time.perf_counter() - t0
+    self.sent += len(view)
+    return len(view)
+  def send(self, commands, cache=None):
+    """Encode commands (any iterable of configs, as for writevdu) and stream them, packing consecutive commands
+    into full chunks. Returns {"log", "size"} like writevdu."""
+    errlog = []
+    pending = bytearray()
+    count = 0
+    for idx, n in enumerate(iprocess(commands, cache)):
+      if len(n["log"])>0:
+        errlog.append("command "+str(idx+1))
+        errlog += n["log"]
+      pending += n["bytes"]
+      if len(pending) >= self.chunksize:
+        whole = len(pending) - len(pending) % self.chunksize
+        count += self.write(memoryview(pending)[:whole])
+        del pending[:whole]
+    if pending:
+      count += self.write(pending)
+    return {"log":errlog,"size":count}
+  def sendfile(self, path):
+    """Stream an existing .vdu file. Returns the number of bytes sent."""
+    count = 0
+    with open(path, "rb") as f:
+      while True:
+        block = f.read(max(self.chunksize, 65536))
+        if not block:
+          break
+        count += self.write(block)
+    return count
+  def stats(self):
+    """Bytes and chunks sent, seconds spent sending, throughput in bytes per second, and that throughput as a
+    fraction of the line rate (baud / 10 bytes per second for 8N1)."""
+    throughput = self.sent / self.seconds if self.seconds > 0 else 0.0
+    return {"bytes":self.sent, "chunks":self.chunks, "seconds":self.seconds, "throughput":throughput,
+      "utilisation":throughput / (self.baud / 10)}